@@ -3,6 +3,10 @@
 """
 Making calls to Illumio API
 Included both Synchronous and Asynchronous version
+Also the JSON codec used to encode requests and decode responses
+And the transports: HTTP/1.1 through requests (default), HTTP/2 through httpx (optional)
+or HTTP/1.1 through the standard library
+The HTTP libraries are only imported when a credential first uses them, so importing this module is cheap
 """
 
 __author__ = "Nghia Huu (David) Nguyen"
@@ -14,10 +18,185 @@ __maintainer__ = "David Nguyen"
 __email__ = "davidnguyen0207@gmail.com"
 __status__ = "In Development"
 
+import os
 import json
+import stat
 import time
-import requests
-from requests.auth import HTTPBasicAuth
+import fcntl
+import hashlib
+import tempfile
+from importlib.util import find_spec
+
+# Use the fastest JSON library available: orjson, then ujson, then the standard library
+try:
+    import orjson as _json_codec
+except ImportError:
+    try:
+        import ujson as _json_codec
+    except ImportError:
+        _json_codec = json
+
+# Optional HTTP/2 transport: httpx with the h2 package
+# Only looked up here, imported on first use
+HAS_HTTP2 = find_spec("httpx") is not None and find_spec("h2") is not None
+
+# Transports a credential can use
+# http1: requests, one TCP+TLS connection per request in flight
+# http2: httpx, every request in flight multiplexed over a single connection
+# stdlib: http.client, one keep-alive connection per thread, nothing to import beyond the standard library
+TRANSPORTS = ('http1', 'http2', 'stdlib')
+
+# Maximum number of connections kept open to each PCE
+POOL_SIZE = 16
+# Compressions we accept from the PCE, exports are mostly repetitive JSON and compress very well
+ACCEPT_ENCODING = "gzip, deflate"
+# Size of the chunks an export result is downloaded (and decompressed) in
+EXPORT_CHUNK_SIZE = 1024 * 1024
+
+# Registry of asynchronous jobs shared by every module process of this user on this controller
+# Concurrent callers asking for the same export reuse one in-progress PCE job instead of starting their own
+# It lives in a directory only the user can access, so other users can neither read nor tamper with it
+ASYNC_REGISTRY_DIR = os.path.join(tempfile.gettempdir(), "respiro_illumio_{}".format(os.getuid()))
+ASYNC_REGISTRY = os.path.join(ASYNC_REGISTRY_DIR, "async_jobs.json")
+# How long (in seconds) an unfinished job is trusted before a new one is started
+ASYNC_JOB_TTL = 3600
+# How long (in seconds) a caller submitting a job is waited for before another one submits it
+ASYNC_SUBMIT_TTL = 60
+# Time (in seconds) between two looks at a job another caller is submitting
+ASYNC_SUBMIT_POLL = 0.5
+
+
+class TransportError(IOError):
+    """The PCE couldn't be reached (whichever transport was used)"""
+
+
+class TransportTimeout(TransportError):
+    """The PCE didn't answer in time (whichever transport was used)"""
+
+
+# Get the connection pool of a credential's PCE, create it on first use
+# Every PCE (credential) has its own pool so calls to different PCEs don't compete for connections
+# With the http2 transport the pool is an httpx client, which sends the requests in flight as streams
+# of one HTTP/2 connection (falling back to HTTP/1.1 connections if the PCE or a proxy doesn't offer HTTP/2)
+def _session(creds):
+    with creds.lock:
+        if creds.session is None:
+            if creds.transport == "http2":
+                if not HAS_HTTP2:
+                    raise RuntimeError("The http2 transport requires the httpx and h2 packages")
+                import httpx
+                creds.session = httpx.Client(http2=True, auth=(creds.username, creds.auth_secret),
+                                             limits=httpx.Limits(max_connections=POOL_SIZE))
+            elif creds.transport == "stdlib":
+                from ansible_collections.respiro.illumio.plugins.module_utils.stdlib_http import StdlibSession
+                creds.session = StdlibSession(creds.username, creds.auth_secret)
+            else:
+                import requests
+                from requests.adapters import HTTPAdapter
+                from requests.auth import HTTPBasicAuth
+                session = requests.Session()
+                session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE))
+                session.auth = HTTPBasicAuth(creds.username, creds.auth_secret)
+                creds.session = session
+        return creds.session
+
+
+# Wait until the credential's rate limit allows another request
+def _throttle(creds):
+    if not creds.rate_limit:
+        return
+    with creds.lock:
+        now = time.time()
+        wait = creds.next_request_at - now
+        creds.next_request_at = max(now, creds.next_request_at) + 1.0 / creds.rate_limit
+    if wait > 0:
+        time.sleep(wait)
+
+
+# Encode a request payload into JSON
+def dumps(payload):
+    return _json_codec.dumps(payload)
+
+
+# Decode JSON (str or bytes)
+def loads(data):
+    return _json_codec.loads(data)
+
+
+# Decode the JSON body of a response
+def decode(response):
+    return loads(response.content)
+
+
+# Send a request to the PCE through the credential's connection pool
+# With stream=True the body is only downloaded when it's read
+# With an adaptive limiter (concurrency.AdaptiveLimiter) on the credential, the request waits for a free slot
+# and its latency and status are reported back to adjust the number of requests in flight
+def _request(creds, http_verb, api_url, headers, payload=None, stream=False):
+    limiter = creds.limiter
+    if limiter is None:
+        _throttle(creds)
+        return _send(creds, http_verb, api_url, headers, payload, stream)
+    generation = limiter.acquire()
+    status = None
+    start = time.time()
+    try:
+        _throttle(creds)
+        start = time.time()
+        response = _send(creds, http_verb, api_url, headers, payload, stream)
+        status = response.status_code
+        return response
+    finally:
+        limiter.release(generation, time.time() - start, status)
+
+
+# Send a request with the credential's transport
+# Connection errors and timeouts of every transport are raised as TransportError and TransportTimeout
+def _send(creds, http_verb, api_url, headers, payload=None, stream=False):
+    # Set connection timeout (avoid hanging, usually when user insert the wrong port number)
+    timeout = 15
+    headers = dict(headers, **{"Accept-Encoding": ACCEPT_ENCODING})
+    session = _session(creds)
+    if creds.transport == "http2":
+        import httpx
+        try:
+            request = session.build_request(http_verb, api_url, headers=headers, timeout=timeout,
+                                            content=dumps(payload))
+            return session.send(request, stream=stream)
+        except httpx.TimeoutException as e:
+            raise TransportTimeout(str(e))
+        except httpx.TransportError as e:
+            raise TransportError(str(e))
+    if creds.transport == "stdlib":
+        import socket
+        import http.client
+        try:
+            return session.request(http_verb, api_url, headers=headers, timeout=timeout, data=dumps(payload),
+                                   stream=stream)
+        except socket.timeout as e:
+            raise TransportTimeout(str(e))
+        except (OSError, http.client.HTTPException) as e:
+            raise TransportError(str(e))
+    import requests
+    try:
+        return session.request(http_verb, api_url, headers=headers, timeout=timeout, data=dumps(payload),
+                               stream=stream)
+    except requests.exceptions.Timeout as e:
+        raise TransportTimeout(str(e))
+    except requests.exceptions.ConnectionError as e:
+        raise TransportError(str(e))
+
+
+# Download the body of a streamed response
+# The body is decompressed chunk by chunk while it's received, in larger chunks than requests' default
+# (which is what response.content would do), so the compressed export is never held in memory
+def _read_stream(response):
+    if hasattr(response, "iter_content"):
+        response._content = b"".join(response.iter_content(EXPORT_CHUNK_SIZE))
+    else:
+        response.read()
+        response.close()
+    return response
 
 
 # Making a synchronous API call
@@ -34,60 +213,225 @@ def sync_api(creds, http_verb, resource, has_org, payload=None):
 
     # Declare headers
     headers = {"Content-Type": "application/json", "Accept": "application/json"}
-    # Set connection timeout (avoid hanging, usually when user insert the wrong port number)
-    timeout = 15
 
     # Make the call
-    response = requests.request(http_verb, api_url, auth=HTTPBasicAuth(creds.username, creds.auth_secret),
-                                headers=headers, timeout=timeout, data=json.dumps(payload))
+    return _request(creds, http_verb, api_url, headers, payload)
 
-    return response
 
+# Identify an asynchronous job by everything that affects its result
+# The PCE, port, org, user (permissions differ between users), full URL and payload
+def _job_key(creds, api_url, payload):
+    identity = json.dumps([creds.pce, creds.port, creds.org_href, creds.username, api_url, payload],
+                          sort_keys=True)
+    return hashlib.sha256(identity.encode("utf-8")).hexdigest()
 
-# Making an asynchronous "GET" API request
-# For OVER 500 items being queried on the server ("GET" operation)
-# NOTE: only apply to "GET" HTTP operation and therefore doesn't require a http verb
-# Requires a credential,
-# Resource to access (e.g. /labels for labels),
-# Does it contains the org_href or not
-# And the data to push (unlikely to be used, since this will be a "GET" operation)
-def async_api(creds, resource, has_org, payload=None):
-    # Use different url depends on if the call requires an org_href
-    if has_org:
-        api_url = creds.url_with_org(resource)
-    else:
-        api_url = creds.url_with_api(resource)
 
+# Create the registry's directory if needed
+# Returns whether it can be used: a directory owned by this user that nobody else can access
+# Otherwise (e.g. another user created it first) jobs are not shared
+def _registry_usable():
+    if not os.path.isdir(ASYNC_REGISTRY_DIR):
+        try:
+            os.mkdir(ASYNC_REGISTRY_DIR, 0o700)
+        except OSError:
+            pass
+    try:
+        status = os.lstat(ASYNC_REGISTRY_DIR)
+    except OSError:
+        return False
+    return stat.S_ISDIR(status.st_mode) and status.st_uid == os.getuid() and not status.st_mode & 0o077
+
+
+# Exclusive lock around the job registry
+# Only held while reading/updating the registry, never while sending requests to the PCE
+class _RegistryLock(object):
+
+    def __enter__(self):
+        self.handle = open(ASYNC_REGISTRY + ".lock", "a")
+        fcntl.flock(self.handle, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.handle, fcntl.LOCK_UN)
+        self.handle.close()
+
+
+# Read the job registry, drop the jobs that can no longer be reused
+# A corrupted or missing registry is treated as empty
+def _load_registry():
+    try:
+        with open(ASYNC_REGISTRY, "r") as registry_file:
+            registry = json.load(registry_file)
+    except (IOError, OSError, ValueError):
+        return dict()
+    now = time.time()
+    for key, job in list(registry.items()):
+        ttl = ASYNC_JOB_TTL if job.get("monitor_url") else ASYNC_SUBMIT_TTL
+        if now - job.get("submitted_at", 0) > ttl:
+            del registry[key]
+    return registry
+
+
+# Write the job registry atomically so readers never see a half written file
+def _save_registry(registry):
+    fd, tmp_path = tempfile.mkstemp(dir=ASYNC_REGISTRY_DIR)
+    with os.fdopen(fd, "w") as tmp_file:
+        json.dump(registry, tmp_file)
+    os.chmod(tmp_path, 0o600)
+    os.rename(tmp_path, ASYNC_REGISTRY)
+
+
+# Remove jobs from the registry, those for which forget(key, job) is true
+def _forget_jobs(forget):
+    if not _registry_usable():
+        return
+    with _RegistryLock():
+        registry = _load_registry()
+        forgotten = [key for key, job in registry.items() if forget(key, job)]
+        for key in forgotten:
+            del registry[key]
+        if forgotten:
+            _save_registry(registry)
+
+
+# Remove a job from the registry, unless it was already replaced by another one
+def _forget_job(key, job):
+    _forget_jobs(lambda other_key, other: other_key == key and other.get("monitor_url") == job["monitor_url"])
+
+
+# Remove the jobs exporting a resource (e.g. /labels) of a credential's org from the registry
+# Called after every write to the resource: a job submitted before the write may not include it,
+# so later callers must start a new one
+def forget_async_jobs(creds, resource):
+    url = creds.url_with_org(resource)
+    _forget_jobs(lambda key, job: job.get("url") == url or job.get("url", "").startswith(url + "?"))
+
+
+# Submit a new asynchronous job to the PCE
+# Returns the job's record: the URL to monitor and the suggested waiting time
+def _submit_job(creds, api_url, payload):
     # Declare headers
     # IMPORTANT: "Prefer": "respond-async" on header
     headers = {"Prefer": "respond-async", "Content-type": "application/json", "Accept": "application/json"}
-    # Set connection timeout (avoid hanging, usually when user insert the wrong port number)
-    timeout = 15
 
     # Make the call
-    response = requests.request("get", api_url, auth=HTTPBasicAuth(creds.username, creds.auth_secret),
-                                headers=headers, timeout=timeout, data=json.dumps(payload))
+    response = _request(creds, "get", api_url, headers, payload)
 
     # Since this is an asynchronous call so instead of the result,
     # The server will send back a special URL; We will perform GET operation on that URL
     # periodically until it's either success or fail
+    return {"url": api_url,
+            "monitor_url": response.headers['Location'],
+            "retry_after": int(response.headers['Retry-After']),
+            "submitted_at": time.time()}
+
+
+# Get an asynchronous job for the request
+# Reuse a job still in progress from the registry if there is one,
+# otherwise submit a new one and register it for other callers
+# While a caller submits a job, the registry holds its placeholder (no monitor_url yet) and
+# other callers wait for the job to be registered rather than submitting their own
+# Returns the registry key, the job and whether it was reused
+def _acquire_job(creds, api_url, payload):
+    key = _job_key(creds, api_url, payload)
+    # Identifies this caller's placeholder, a write may remove it (see forget_async_jobs) while the job is submitted
+    token = os.urandom(16).hex()
+    shared = _registry_usable()
+    while shared:
+        with _RegistryLock():
+            registry = _load_registry()
+            job = registry.get(key)
+            if job is None:
+                registry[key] = {"url": api_url, "monitor_url": None, "submitted_at": time.time(), "token": token}
+                _save_registry(registry)
+                break
+        if job.get("monitor_url"):
+            return key, job, True
+        time.sleep(ASYNC_SUBMIT_POLL)
 
+    try:
+        job = _submit_job(creds, api_url, payload)
+    except Exception:
+        if shared:
+            _forget_jobs(lambda other_key, other: other_key == key and other.get("token") == token)
+        raise
+    # The job is only shared if the placeholder is still there: if a write removed it,
+    # the job may predate the write and is used by this caller alone
+    if shared:
+        with _RegistryLock():
+            registry = _load_registry()
+            if registry.get(key, dict()).get("token") == token:
+                registry[key] = job
+                _save_registry(registry)
     # First we wait for suggested amount of time (provided by the server)
-    time.sleep(int(response.headers['Retry-After']))
+    time.sleep(job["retry_after"])
+    return key, job, False
 
-    # Then we query the second URL periodically until we get a confirmation
+
+# Query the monitor URL periodically until the job is either done or failed
+# Returns the href of the job's result, None if the job failed
+def _wait_for_job(creds, job):
     status = ""
-    monitor_url = response.headers['Location']
     while status != "done" and status != "failed":
-        response = sync_api(creds, "get", monitor_url, False)
-        status = json.loads(response.content)['status']
-        time.sleep(1)
+        response = sync_api(creds, "get", job["monitor_url"], False)
+        status = decode(response)['status']
+        if status != "done" and status != "failed":
+            time.sleep(1)
+    if status == "failed":
+        return None
+    return decode(response)['result']['href']
 
-    # After the status on the second URL become "done"
-    # The server will send us a third URL
-    # Use the HREF to get results of the request
-    response = sync_api(creds, "get", json.loads(response.content)['result']['href'], False)
 
-    return response
+# Making an asynchronous "GET" API request
+# For OVER 500 items being queried on the server ("GET" operation)
+# NOTE: only apply to "GET" HTTP operation and therefore doesn't require a http verb
+# Requires a credential,
+# Resource to access (e.g. /labels for labels),
+# Does it contains the org_href or not
+# And the data to push (unlikely to be used, since this will be a "GET" operation)
+def async_api(creds, resource, has_org, payload=None):
+    # Use different url depends on if the call requires an org_href
+    if has_org:
+        api_url = creds.url_with_org(resource)
+    else:
+        api_url = creds.url_with_api(resource)
+
+    # Share the job with every other caller asking for the same data while it's in progress
+    # A finished job is removed from the registry, later callers start a new one so they see the latest data
+    # A reused job might have failed or its result might be gone already,
+    # in which case we try again with a fresh job
+    reused = True
+    while reused:
+        key, job, reused = _acquire_job(creds, api_url, payload)
+        result_href = _wait_for_job(creds, job)
+        _forget_job(key, job)
+        if result_href is None:
+            if reused:
+                continue
+            raise RuntimeError("Asynchronous request for {} failed on the PCE".format(resource))
+
+        # After the status on the second URL become "done"
+        # The server will send us a third URL
+        # Use the HREF to get results of the request
+        # The result is streamed and decompressed as it's received
+        headers = {"Content-Type": "application/json", "Accept": "application/json"}
+        response = _read_stream(_request(creds, "get", creds.url_with_api(result_href), headers, stream=True))
+        if response.status_code != 200 and reused:
+            continue
+        return response
 
 
+# Decode a JSON array one element at a time
+# Lets callers convert each element (e.g. into a compact record) as soon as it's decoded,
+# so the full list of decoded objects is never held in memory at once
+def iter_json_array(text):
+    decoder = json.JSONDecoder()
+    index = text.index("[") + 1
+    length = len(text)
+    while True:
+        while index < length and text[index] in " \t\r\n,":
+            index += 1
+        if index >= length or text[index] == "]":
+            return
+        item, index = decoder.raw_decode(text, index)
+        yield item
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+"""
+Client of the controller-local PCE cache (see cache_daemon):
+- Find the cache's unix socket for a PCE/org
+- Get labels or workloads from the cache
+- Tell the cache that its copy is out of date
+Only a socket owned by the user (and not accessible to others) is used
+Every call returns None when the cache isn't running, so callers can fall back to the API
+"""
+
+__author__ = "Nghia Huu (David) Nguyen"
+__copyright__ = "Copyright 2021"
+__credits__ = ["David Nguyen"]
+__license__ = "GPL"
+__version__ = "1.0.0"
+__maintainer__ = "David Nguyen"
+__email__ = "davidnguyen0207@gmail.com"
+__status__ = "In Development"
+
+# Import required modules
+from ansible_collections.respiro.illumio.plugins.module_utils.api_calls import dumps, loads
+import os
+import stat
+import socket
+import hashlib
+import tempfile
+
+# Environment variable overriding the cache's socket path
+CACHE_SOCKET_ENV = "ILLUMIO_CACHE_SOCKET"
+# Resources the cache holds
+CACHE_RESOURCES = ("labels", "workloads")
+# Time (in seconds) to wait for the cache before falling back to the API
+CLIENT_TIMEOUT = 60
+
+
+# Path of the cache's socket for a credential's PCE and org
+def cache_socket_path(creds):
+    if os.environ.get(CACHE_SOCKET_ENV):
+        return os.environ[CACHE_SOCKET_ENV]
+    org_id = creds.org_href.rstrip("/").split("/")[-1]
+    return os.path.join(tempfile.gettempdir(), "respiro_illumio_{}_{}_{}.sock".format(creds.pce, creds.port, org_id))
+
+
+# Identity of a credential, the cache only answers requests made for the PCE, org and user it serves
+# The secret itself is never sent, only its digest
+def cache_identity(creds):
+    return dict(pce=creds.pce, port=creds.port, org_href=creds.org_href, username=creds.username,
+                secret_digest=hashlib.sha256(creds.auth_secret.encode("utf-8")).hexdigest())
+
+
+# Whether the socket at path can be trusted: a socket owned by this user that nobody else can access
+# (the cache creates it with mode 0600), so its answers aren't coming from another user's process
+def _trusted_socket(path):
+    try:
+        status = os.stat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(status.st_mode) and status.st_uid == os.getuid() and not status.st_mode & 0o077
+
+
+# Send a request to the cache and return its decoded answer
+# None if the cache isn't running, its socket can't be trusted or it didn't answer properly
+def _call(creds, request):
+    path = cache_socket_path(creds)
+    if not _trusted_socket(path):
+        return None
+    request = dict(request, **cache_identity(creds))
+    data = dumps(request)
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(CLIENT_TIMEOUT)
+        client.connect(path)
+        client.sendall(data + b"\n")
+        chunks = []
+        while True:
+            chunk = client.recv(1024 * 1024)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        response = loads(b"".join(chunks))
+    except (socket.error, OSError, ValueError):
+        return None
+    finally:
+        client.close()
+    if not isinstance(response, dict) or "error" in response:
+        return None
+    return response
+
+
+# Get a resource ("labels" or "workloads") from the cache, as the list of dicts the PCE would return
+# None if the cache isn't running or doesn't have the resource yet
+def query_cache(creds, resource):
+    response = _call(creds, dict(action="get", resource=resource))
+    return response.get("data") if response else None
+
+
+# Tell the cache its copy of a resource is out of date (e.g. after creating labels)
+# The cache stops serving it until it has been refreshed
+def invalidate_cache(creds, resource):
+    _call(creds, dict(action="invalidate", resource=resource))
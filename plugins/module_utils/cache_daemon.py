@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+"""
+Controller-local PCE cache, shared by every module process over a unix socket:
+- Owns one connection pool to the PCE and an in-memory copy of its labels and workloads
+- Refreshes the copy in the background
+- Answers "get" and "invalidate" requests from cache_client
+
+Start it on the controller before the play, e.g.:
+ILLUMIO_USERNAME=... ILLUMIO_AUTH_SECRET=... python -m \
+    ansible_collections.respiro.illumio.plugins.module_utils.cache_daemon --pce poc1.illum.io --org-id 80
+"""
+
+__author__ = "Nghia Huu (David) Nguyen"
+__copyright__ = "Copyright 2021"
+__credits__ = ["David Nguyen"]
+__license__ = "GPL"
+__version__ = "1.0.0"
+__maintainer__ = "David Nguyen"
+__email__ = "davidnguyen0207@gmail.com"
+__status__ = "In Development"
+
+# Import required modules
+from ansible_collections.respiro.illumio.plugins.module_utils.api_calls import decode, dumps, loads
+from ansible_collections.respiro.illumio.plugins.module_utils.cache_client import CACHE_RESOURCES, \
+    cache_identity, cache_socket_path
+from ansible_collections.respiro.illumio.plugins.module_utils.credential import Credential
+from ansible_collections.respiro.illumio.plugins.module_utils.labels import get_labels
+from ansible_collections.respiro.illumio.plugins.module_utils.workloads import get_workloads
+import os
+import sys
+import argparse
+import threading
+import socketserver
+
+# Default time (in seconds) between two refreshes of the inventory
+REFRESH_INTERVAL = 300
+
+
+class PceCache(object):
+
+    # Initialise the cache of a credential's PCE, nothing is loaded yet
+    def __init__(self, creds, refresh_interval=REFRESH_INTERVAL):
+        self.creds = creds
+        self.refresh_interval = refresh_interval
+        # Resource name -> JSON encoded list, as sent to the clients
+        self.encoded = dict()
+        # Resource name -> number of invalidations so far
+        # A refresh only stores what it fetched if the resource wasn't invalidated in the meantime
+        self.generations = dict((resource, 0) for resource in CACHE_RESOURCES)
+        self.lock = threading.Lock()
+        # Set to refresh before the next interval (e.g. after an invalidation)
+        self.wake_up = threading.Event()
+
+    # Fetch every resource from the PCE and replace the cached copies
+    # The JSON is encoded once here rather than for every client
+    # Goes straight to the PCE (not through fetch_workloads/create_label_href_dict, which would ask this cache)
+    # Data fetched while the resource was invalidated may predate the write, it's thrown away
+    # (the invalidation already asked for another refresh)
+    def refresh(self):
+        fetchers = dict(labels=lambda creds: decode(get_labels(creds)),
+                        workloads=lambda creds: decode(get_workloads(creds)))
+        for resource in CACHE_RESOURCES:
+            with self.lock:
+                generation = self.generations[resource]
+            data = dumps(fetchers[resource](self.creds))
+            if not isinstance(data, bytes):
+                data = data.encode("utf-8")
+            with self.lock:
+                if self.generations[resource] == generation:
+                    self.encoded[resource] = data
+
+    # Refresh the cache forever, every refresh_interval or as soon as something was invalidated
+    # Errors are reported and the previous copies kept (unless invalidated)
+    def refresh_forever(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                sys.stderr.write("Refresh failed: {}\n".format(e))
+            self.wake_up.wait(self.refresh_interval)
+            self.wake_up.clear()
+
+    # Stop serving a resource until the next refresh, which is started straight away
+    def invalidate(self, resource):
+        with self.lock:
+            self.generations[resource] += 1
+            self.encoded.pop(resource, None)
+        self.wake_up.set()
+
+    # Answer a decoded request from a client, returns the encoded response
+    def handle(self, request):
+        identity = cache_identity(self.creds)
+        if any(request.get(key) != value for key, value in identity.items()):
+            return b'{"error": "This cache serves another PCE, org or user"}'
+        if request.get("resource") not in CACHE_RESOURCES:
+            return b'{"error": "Unknown resource"}'
+        if request.get("action") == "invalidate":
+            self.invalidate(request["resource"])
+            return b'{"ok": true}'
+        with self.lock:
+            data = self.encoded.get(request["resource"])
+        if data is None:
+            return b'{"error": "Not loaded yet"}'
+        return b'{"data": ' + data + b'}'
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    # One JSON request per line, the response is sent back and the connection closed
+    def handle(self):
+        try:
+            request = loads(self.rfile.readline())
+        except ValueError:
+            self.wfile.write(b'{"error": "Invalid request"}')
+            return
+        self.wfile.write(self.server.cache.handle(request))
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+# Serve the cache of a credential's PCE on its unix socket until interrupted
+# The socket is only accessible to the user running the cache
+def serve(creds, socket_path=None, refresh_interval=REFRESH_INTERVAL):
+    socket_path = socket_path or cache_socket_path(creds)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    cache = PceCache(creds, refresh_interval)
+    refresher = threading.Thread(target=cache.refresh_forever)
+    refresher.daemon = True
+    refresher.start()
+
+    old_umask = os.umask(0o177)
+    try:
+        server = _Server(socket_path, _RequestHandler)
+    finally:
+        os.umask(old_umask)
+    server.cache = cache
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Controller-local cache of an Illumio PCE's labels and workloads. "
+                                                 "Credentials are read from ILLUMIO_USERNAME and ILLUMIO_AUTH_SECRET.")
+    parser.add_argument("--pce", required=True)
+    parser.add_argument("--org-id", required=True)
+    parser.add_argument("--port", default="443")
+    parser.add_argument("--socket", help="Socket path (default: derived from the PCE and org, in the temp directory)")
+    parser.add_argument("--refresh-interval", type=int, default=REFRESH_INTERVAL)
+    args = parser.parse_args()
+    creds = Credential(os.environ["ILLUMIO_USERNAME"], os.environ["ILLUMIO_AUTH_SECRET"], args.pce,
+                       "/orgs/" + args.org_id, args.port)
+    try:
+        serve(creds, args.socket, args.refresh_interval)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+"""
+Running operations concurrently:
+- Run a function over a list of items with a pool of threads
+- Run the same operation against several PCEs/orgs at once
+- Fetch several independent collections (e.g. labels and workloads) at once
+- Adapt the number of requests in flight to a PCE to its observed latency and errors (AIMD)
+"""
+
+__author__ = "Nghia Huu (David) Nguyen"
+__copyright__ = "Copyright 2021"
+__credits__ = ["David Nguyen"]
+__license__ = "GPL"
+__version__ = "1.0.0"
+__maintainer__ = "David Nguyen"
+__email__ = "davidnguyen0207@gmail.com"
+__status__ = "In Development"
+
+# Import required modules
+from ansible_collections.respiro.illumio.plugins.module_utils.api_calls import POOL_SIZE
+import threading
+
+# Default number of requests in flight at the same time
+DEFAULT_WORKERS = 8
+
+# Adaptive concurrency (AIMD: additive increase, multiplicative decrease)
+# Requests in flight to start with, and the bounds of the limit
+# The upper bound is the size of the connection pool, more requests would need extra connections
+ADAPTIVE_INITIAL = 4
+ADAPTIVE_MINIMUM = 1
+ADAPTIVE_MAXIMUM = POOL_SIZE
+# Number of requests the latency is measured over before the limit is adjusted
+ADAPTIVE_WINDOW = 20
+# The limit is cut when the p95 latency of a window goes over this multiple of the baseline
+LATENCY_TOLERANCE = 2.0
+# Factor the limit is multiplied by when the PCE shows signs of overload
+DECREASE_FACTOR = 0.5
+# The baseline (lowest p95 seen) is allowed to rise by this factor per window,
+# so a PCE that is lastingly slower (e.g. business hours) isn't mistaken for an overloaded one
+BASELINE_DRIFT = 1.05
+# On a cut caused by latency, the baseline moves this fraction of the way towards the p95 (EWMA)
+# A PCE whose latency settles higher is only treated as overloaded for a few windows, then the limit grows again
+BASELINE_CATCH_UP = 0.25
+# HTTP statuses meaning the PCE is overloaded
+OVERLOAD_STATUSES = (429, 503)
+
+
+class AdaptiveLimiter(object):
+
+    # Limit of the requests in flight to a PCE, adjusted from the latency and errors of the requests
+    # Raised by one after every healthy window, halved on 429/503, timeouts and connection errors,
+    # or when the p95 latency rises above LATENCY_TOLERANCE times the baseline
+    # The baseline follows the lowest healthy p95, and catches up with a lastingly higher one after latency cuts
+    def __init__(self, initial=ADAPTIVE_INITIAL, minimum=ADAPTIVE_MINIMUM, maximum=ADAPTIVE_MAXIMUM,
+                 window=ADAPTIVE_WINDOW):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        # Latencies of the current window and whether it saw an overload
+        self.latencies = []
+        self.overloaded = False
+        # Incremented on every adjustment, requests started before it don't count for the new window
+        # (a burst of 429s on requests already in flight only cuts the limit once)
+        self.generation = 0
+        self.baseline = None
+        self.last_p95 = None
+        self.lowest = self.highest = int(initial)
+        self.decreases = 0
+
+    # Wait for a free slot, returns the generation to give back to release
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            return self.generation
+
+    # Free a slot and record how the request went
+    # status is the response's HTTP status, None if the request failed (timeout, connection error)
+    def release(self, generation, latency, status=None):
+        overloaded = status is None or status in OVERLOAD_STATUSES
+        with self.condition:
+            self.in_flight -= 1
+            if generation == self.generation:
+                self.latencies.append(latency)
+                self.overloaded = self.overloaded or overloaded
+                if overloaded or len(self.latencies) >= self.window:
+                    self._adjust()
+            self.condition.notify_all()
+
+    def _adjust(self):
+        latencies = sorted(self.latencies)
+        p95 = latencies[int(0.95 * (len(latencies) - 1))]
+        if self.overloaded or (self.baseline is not None and p95 > self.baseline * LATENCY_TOLERANCE):
+            self.limit = max(self.minimum, self.limit * DECREASE_FACTOR)
+            self.decreases += 1
+            if not self.overloaded:
+                self.baseline += (p95 - self.baseline) * BASELINE_CATCH_UP
+        else:
+            self.limit = min(self.maximum, self.limit + 1)
+            self.baseline = p95 if self.baseline is None else min(self.baseline * BASELINE_DRIFT, p95)
+        self.last_p95 = p95
+        self.lowest = min(self.lowest, int(self.limit))
+        self.highest = max(self.highest, int(self.limit))
+        self.latencies = []
+        self.overloaded = False
+        self.generation += 1
+
+    # Current state, to be reported in the module's result
+    def stats(self):
+        with self.condition:
+            return dict(limit=int(self.limit), min_limit=self.lowest, max_limit=self.highest,
+                        decreases=self.decreases,
+                        p95_ms=round(self.last_p95 * 1000, 1) if self.last_p95 is not None else None)
+
+
+# Number of threads to run a credential's requests with
+# With an adaptive limit, enough threads for its maximum: the limiter decides how many requests are in flight
+def workers_for(creds, workers=DEFAULT_WORKERS):
+    return creds.limiter.maximum if creds.limiter else workers
+
+
+# Add the adaptive concurrency state of the credential (if it has one) to a result, under "concurrency"
+def with_concurrency(cred, result):
+    if cred.limiter:
+        result['concurrency'] = cred.limiter.stats()
+    return result
+
+
+# Apply func to every item using up to "workers" threads
+# Returns the results in the same order as the items
+# Exceptions raised by func are propagated to the caller
+# The thread pool is only imported when there is more than one item to run at once
+def run_concurrently(func, items, workers=DEFAULT_WORKERS):
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        return list(executor.map(func, items))
+
+
+# Fetch several independent collections from the same PCE at the same time
+# Each keyword maps a name to a function taking the credential (e.g. labels=create_label_href_dict)
+# Exports are mostly waiting for the PCE (probe, asynchronous job, polling, download),
+# so running them side by side takes as long as the slowest one instead of the sum
+# Returns {name: result}
+def prefetch(cred, **fetches):
+    names = list(fetches)
+    results = run_concurrently(lambda name: fetches[name](cred), names, len(names))
+    return dict(zip(names, results))
+
+
+# Run operation(cred, *args) against every credential at the same time
+# Each credential has its own connection pool and rate limit, so the total time
+# is the time of the slowest PCE rather than the sum of all of them
+# Returns one result dict per credential, tagged with its pce and org_href
+# A PCE that raised an error is reported as failed without affecting the others
+def fan_out(creds_list, operation, *args):
+    def run(cred):
+        try:
+            result = operation(cred, *args)
+        except Exception as e:
+            result = dict(changed=False, failed=True, msg=str(e))
+        with_concurrency(cred, result)
+        result['pce'] = cred.pce
+        result['org_href'] = cred.org_href
+        return result
+    return run_concurrently(run, creds_list, len(creds_list))
+
+
+# Exit the module with the per-target results of fan_out (and any extra top-level entries)
+# The module fails if any of the targets failed
+def exit_fan_out(module, results, **extra):
+    changed = any(result.get('changed') for result in results)
+    failed = [result for result in results if result.get('failed')]
+    if failed:
+        module.fail_json(msg="{} of {} targets failed".format(len(failed), len(results)),
+                         changed=changed, targets=results, **extra)
+    module.exit_json(changed=changed, targets=results, **extra)
@@ -15,17 +15,45 @@ __maintainer__ = "David Nguyen"
 __email__ = "davidnguyen0207@gmail.com"
 __status__ = "In Development"
 
+from ansible_collections.respiro.illumio.plugins.module_utils.concurrency import AdaptiveLimiter
+import threading
+
+# Options of each entry in a module's "targets" parameter
+# username, auth_secret and port default to the module's top-level values
+TARGET_OPTIONS = dict(
+    pce=dict(type='str', required=True),
+    org_id=dict(type='str', required=True),
+    port=dict(type='str', required=False),
+    username=dict(type='str', required=False),
+    auth_secret=dict(type='str', required=False, no_log=True),
+)
+
 
 class Credential(object):
 
     # Initialise Credential
     # Default port is 443
-    def __init__(self, username, auth_secret, pce, org_href, port="443"):
+    # rate_limit is the maximum number of requests per second sent to the PCE (None for no limit)
+    # transport is "http1" (requests), "http2" (httpx, requests multiplexed over one connection)
+    # or "stdlib" (http.client)
+    # concurrency is "fixed" (the callers' number of workers) or "adaptive" (adjusted to the PCE's latency)
+    def __init__(self, username, auth_secret, pce, org_href, port="443", rate_limit=None, transport="http1",
+                 concurrency="fixed"):
         self.username = username
         self.auth_secret = auth_secret
         self.pce = pce
         self.org_href = org_href
         self.port = port
+        self.rate_limit = rate_limit
+        self.transport = transport or "http1"
+        # Limit of the requests in flight, adjusted by api_calls from the PCE's latency and errors
+        self.limiter = AdaptiveLimiter() if concurrency == "adaptive" else None
+        # Connection pool to the PCE, created by api_calls on first use
+        self.session = None
+        # Earliest time the next request may be sent (used to enforce rate_limit)
+        self.next_request_at = 0.0
+        # Guards the session and rate limit state when the credential is shared by threads
+        self.lock = threading.Lock()
 
     # For API call without org_href
     # "rest" mean the rest of the API call
@@ -46,3 +74,25 @@ class Credential(object):
         return "https://" + self.pce + ":" + self.port + "/api/v2" + self.org_href + "/" + rest
 
 
+# Build the credentials a module should run against from its parameters
+# If "targets" is given, one credential is created per PCE/org in the list,
+# otherwise a single credential is created from the pce and org_id parameters
+def credentials_from_params(params):
+    username = params.get('username')
+    auth_secret = params.get('auth_secret')
+    port = params.get('port') or "443"
+    rate_limit = params.get('rate_limit')
+    transport = params.get('transport')
+    concurrency = params.get('concurrency')
+    targets = params.get('targets') or [dict(pce=params.get('pce'), org_id=params.get('org_id'))]
+    creds = []
+    for target in targets:
+        creds.append(Credential(target.get('username') or username,
+                                target.get('auth_secret') or auth_secret,
+                                target['pce'],
+                                "/orgs/" + target['org_id'],
+                                target.get('port') or port,
+                                rate_limit,
+                                transport,
+                                concurrency))
+    return creds
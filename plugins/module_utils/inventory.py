@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+"""
+Local SQLite store of the PCE's inventory:
+- Labels, workloads, their interface addresses and workload-label links
+- Bulk load from exports (replacing the previous content)
+- Indexed queries by href, hostname, IP and label
+- Refresh the store from the PCE
+"""
+
+__author__ = "Nghia Huu (David) Nguyen"
+__copyright__ = "Copyright 2021"
+__credits__ = ["David Nguyen"]
+__license__ = "GPL"
+__version__ = "1.0.0"
+__maintainer__ = "David Nguyen"
+__email__ = "davidnguyen0207@gmail.com"
+__status__ = "In Development"
+
+# Import required modules
+from ansible_collections.respiro.illumio.plugins.module_utils.api_calls import decode
+from ansible_collections.respiro.illumio.plugins.module_utils.labels import LABEL_TYPES, get_labels, sync_labels
+from ansible_collections.respiro.illumio.plugins.module_utils.workloads import fetch_workloads, sync_workloads
+from ansible_collections.respiro.illumio.plugins.module_utils.concurrency import prefetch
+import sqlite3
+import ipaddress
+
+# Tables and indexes of the store
+# IP addresses are also stored as (version, zero-padded hex) so subnets can be queried as ranges
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS labels (
+    href TEXT PRIMARY KEY,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS labels_key_value ON labels (key, value);
+CREATE TABLE IF NOT EXISTS workloads (
+    href TEXT PRIMARY KEY,
+    name TEXT,
+    hostname TEXT,
+    managed INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS workloads_hostname ON workloads (hostname COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS workload_ips (
+    workload_href TEXT NOT NULL,
+    address TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    sort_key TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS workload_ips_address ON workload_ips (address);
+CREATE INDEX IF NOT EXISTS workload_ips_range ON workload_ips (version, sort_key);
+CREATE INDEX IF NOT EXISTS workload_ips_workload ON workload_ips (workload_href);
+CREATE TABLE IF NOT EXISTS workload_labels (
+    workload_href TEXT NOT NULL,
+    label_href TEXT NOT NULL,
+    PRIMARY KEY (workload_href, label_href)
+);
+CREATE INDEX IF NOT EXISTS workload_labels_label ON workload_labels (label_href);
+"""
+
+
+# Sortable text key of an IP address
+# Same length for every address of a version, so text order is numeric order
+def _ip_sort_key(ip):
+    return "{:032x}".format(int(ip))
+
+
+class InventoryStore(object):
+
+    # Open (or create) the store at "path"
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Replace the labels with the content of a label export (list of label dicts)
+    def load_labels(self, labels_list):
+        with self.connection:
+            self.connection.execute("DELETE FROM labels")
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO labels (href, key, value) VALUES (?, ?, ?)",
+                ((label['href'], label['key'], label['value']) for label in labels_list))
+
+    # Replace the workloads (and their addresses and labels) with the content of a workload export
+    # (list of workload dicts, as returned by the PCE)
+    def load_workloads(self, workloads_list):
+        workloads_rows = []
+        ip_rows = []
+        label_rows = []
+        for workload in workloads_list:
+            href = workload['href']
+            managed = workload.get('managed', bool((workload.get('agent') or dict()).get('href')))
+            workloads_rows.append((href, workload.get('name'), workload.get('hostname'), 1 if managed else 0))
+            for interface in workload.get('interfaces') or []:
+                try:
+                    ip = ipaddress.ip_address(interface.get('address'))
+                except ValueError:
+                    continue
+                ip_rows.append((href, str(ip), ip.version, _ip_sort_key(ip)))
+            for label in workload.get('labels') or []:
+                label_rows.append((href, label['href']))
+        with self.connection:
+            for table in ("workloads", "workload_ips", "workload_labels"):
+                self.connection.execute("DELETE FROM " + table)
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO workloads (href, name, hostname, managed) VALUES (?, ?, ?, ?)",
+                workloads_rows)
+            self.connection.executemany(
+                "INSERT INTO workload_ips (workload_href, address, version, sort_key) VALUES (?, ?, ?, ?)", ip_rows)
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO workload_labels (workload_href, label_href) VALUES (?, ?)", label_rows)
+
+    # Labels as the dict returned by labels.create_label_href_dict: {type: {name: href}}
+    def label_href_dict(self):
+        labels = dict((key, dict()) for key in LABEL_TYPES)
+        for row in self.connection.execute("SELECT href, key, value FROM labels"):
+            labels.setdefault(row['key'], dict())[row['value']] = row['href']
+        return labels
+
+    # Get a label's href from its type and name, None if there is no such label
+    def label_href(self, key, value):
+        row = self.connection.execute("SELECT href FROM labels WHERE key = ? AND value = ?", (key, value)).fetchone()
+        return row['href'] if row else None
+
+    # Get a workload from its href, None if there is no such workload
+    def workload(self, href):
+        return self.connection.execute("SELECT * FROM workloads WHERE href = ?", (href,)).fetchone()
+
+    # Get the workloads with a hostname (case insensitive)
+    def workloads_by_hostname(self, hostname):
+        return self.connection.execute(
+            "SELECT * FROM workloads WHERE hostname = ? COLLATE NOCASE", (hostname,)).fetchall()
+
+    # Get the workloads with an interface address in "value", a single IP or a subnet in CIDR notation
+    def workloads_by_ip(self, value):
+        network = ipaddress.ip_network(value.strip(), strict=False)
+        return self.connection.execute(
+            "SELECT DISTINCT w.* FROM workloads w JOIN workload_ips i ON i.workload_href = w.href "
+            "WHERE i.version = ? AND i.sort_key BETWEEN ? AND ?",
+            (network.version, _ip_sort_key(network.network_address),
+             _ip_sort_key(network.broadcast_address))).fetchall()
+
+    # Get the workloads that have the label (type and name)
+    def workloads_with_label(self, key, value):
+        return self.connection.execute(
+            "SELECT w.* FROM workloads w JOIN workload_labels wl ON wl.workload_href = w.href "
+            "JOIN labels l ON l.href = wl.label_href WHERE l.key = ? AND l.value = ?", (key, value)).fetchall()
+
+    # Get the workloads that have no label of a type (e.g. no app label)
+    # Optionally only among the workloads with another label (e.g. env=prod but no app label)
+    def workloads_without_label_type(self, missing_key, key=None, value=None):
+        query = ("SELECT w.* FROM workloads w WHERE NOT EXISTS ("
+                 "SELECT 1 FROM workload_labels wl JOIN labels l ON l.href = wl.label_href "
+                 "WHERE wl.workload_href = w.href AND l.key = ?)")
+        params = [missing_key]
+        if key is not None:
+            query += (" AND EXISTS (SELECT 1 FROM workload_labels wl JOIN labels l ON l.href = wl.label_href "
+                      "WHERE wl.workload_href = w.href AND l.key = ? AND l.value = ?)")
+            params += [key, value]
+        return self.connection.execute(query, params).fetchall()
+
+    # Get the hrefs of a workload's labels
+    def workload_label_hrefs(self, workload_href):
+        return [row['label_href'] for row in self.connection.execute(
+            "SELECT label_href FROM workload_labels WHERE workload_href = ?", (workload_href,))]
+
+
+# Open the store at "path" and reload it with the PCE's labels and workloads
+# With snapshot_dir, the exports come from the local snapshots (only the changes are fetched)
+# Returns the store, to be closed by the caller
+def refresh_inventory(creds, path, snapshot_dir=None):
+    # Labels and workloads are fetched at the same time
+    if snapshot_dir:
+        inventory = prefetch(creds,
+                             labels=lambda creds: sync_labels(creds, snapshot_dir),
+                             workloads=lambda creds: sync_workloads(creds, snapshot_dir))
+    else:
+        inventory = prefetch(creds,
+                             labels=lambda creds: decode(get_labels(creds)),
+                             workloads=fetch_workloads)
+    store = InventoryStore(path)
+    store.load_labels(inventory['labels'])
+    store.load_workloads(inventory['workloads'])
+    return store
@@ -6,7 +6,12 @@ Operations with labels:
 - Get a particular label
 - Get labels
 - Update a label's value (name)
+- Delete labels
+- Count how many workloads use each label
 - Create a dictionary that contains formatted labels' data
+- Resolve all labels used by a set of rows at once, creating the missing ones
+- Merge several rows of labels for the same workload into one
+- Keep a local snapshot of the labels up to date with the changes made since the last run
 """
 
 __author__ = "Nghia Huu (David) Nguyen"
@@ -19,14 +24,38 @@ __email__ = "davidnguyen0207@gmail.com"
 __status__ = "In Development"
 
 # Import required modules
-from ansible_collections.respiro.illumio.plugins.module_utils.api_calls import sync_api, async_api
-import json
+from ansible_collections.respiro.illumio.plugins.module_utils.api_calls import sync_api, async_api, decode, \
+    forget_async_jobs
+from ansible_collections.respiro.illumio.plugins.module_utils.snapshot import snapshot_path, sync_snapshot
+from ansible_collections.respiro.illumio.plugins.module_utils.concurrency import DEFAULT_WORKERS, run_concurrently, \
+    workers_for
+from ansible_collections.respiro.illumio.plugins.module_utils.cache_client import query_cache, invalidate_cache
+from collections import Counter
+from types import MappingProxyType
+import time
+
+# Label's types that can be assigned to a workload
+# Also the names of the csv columns holding them
+LABEL_TYPES = ('role', 'app', 'env', 'loc')
+# Ways to merge several rows of labels for the same workload
+# last_wins: the last row gives all the labels
+# fill: each type takes the first non-empty value, later rows only fill the empty types
+MERGE_RULES = ('last_wins', 'fill')
+
+
+# After a write to the labels, stop serving copies of the labels made before it:
+# exports started before the write are no longer shared and the controller's cache is invalidated
+def _labels_written(creds):
+    forget_async_jobs(creds, "/labels")
+    invalidate_cache(creds, "labels")
 
 
 # Create new label
 # Required a credential, a label's type and label's name
 def create_label(creds, type, name):
-    return sync_api(creds, "post", "/labels", True, {"key": type, "value": name})
+    response = sync_api(creds, "post", "/labels", True, {"key": type, "value": name})
+    _labels_written(creds)
+    return response
 
 
 # Get a particular label
@@ -50,7 +79,36 @@ def get_labels(creds):
 # Update label's name
 # Required credential, href of target label and new name
 def update_label(creds, label_href, payload):
-    return sync_api(creds, "put", label_href, False, payload)
+    response = sync_api(creds, "put", label_href, False, payload)
+    _labels_written(creds)
+    return response
+
+
+# Delete a label
+# Required a credential and the href of the label
+# The PCE refuses to delete a label that is still in use (by a workload, rule, ruleset,...)
+def delete_label(creds, label_href):
+    response = sync_api(creds, "delete", label_href, False)
+    _labels_written(creds)
+    return response
+
+
+# Delete labels concurrently
+# Returns the responses in the same order as the hrefs
+def delete_labels(creds, label_hrefs_list, workers=DEFAULT_WORKERS):
+    return run_concurrently(lambda label_href: delete_label(creds, label_href), label_hrefs_list,
+                            workers_for(creds, workers))
+
+
+# Count, in one pass over a workload export, how many workloads use each label
+# Takes workload dicts (labels as a list of {"href": ...}) or compact records (labels as a tuple of hrefs)
+# Returns a Counter {label href: number of workloads}, labels used by no workload are not in it
+def label_usage(workloads_list):
+    usage = Counter()
+    for workload in workloads_list:
+        labels = workload['labels'] if isinstance(workload, dict) else workload.labels
+        usage.update(label if isinstance(label, str) else label['href'] for label in labels or ())
+    return usage
 
 
 # This function will take a credential
@@ -58,9 +116,16 @@ def update_label(creds, label_href, payload):
 # The dict will contain 4 keys corresponded with 4 label's types (role, app, env, loc)
 # The value inside each key is another dict contains all the existing labels of that type
 # Inside the inner dict, the key is the label's name and value is label's href
+# The labels come from the controller's cache if it's running, from the PCE otherwise
 def create_label_href_dict(creds):
-    response = get_labels(creds)
-    labels_list = json.loads(response.content)
+    labels_list = query_cache(creds, "labels")
+    if labels_list is None:
+        labels_list = decode(get_labels(creds))
+    return label_href_dict(labels_list)
+
+
+# Same as create_label_href_dict, from a list of labels that was already retrieved
+def label_href_dict(labels_list):
     labels = dict()
     labels['role'] = dict()
     labels['app'] = dict()
@@ -76,3 +141,72 @@ def create_label_href_dict(creds):
         if label['key'] == "loc":
             labels['loc'][label['value']] = label['href']
     return labels
+
+
+# Get all labels on PCE as a list, from a local snapshot kept in "directory"
+# Only the labels changed since the last run are fetched from the PCE
+# Falls back to a full export when there is no usable snapshot
+def sync_labels(creds, directory):
+    return sync_snapshot(creds, snapshot_path(directory, creds, "labels"), "label",
+                         lambda creds: decode(get_labels(creds)))
+
+
+# Resolve every label used in the rows (dicts with role/app/env/loc keys, e.g. csv rows) to its href
+# The distinct (type, name) pairs are collected first and the missing labels are created concurrently,
+# so the number of requests depends on the number of distinct new labels, not the number of rows
+# Takes the existing labels from create_label_href_dict (fetched if not given)
+# Returns a read-only lookup table {type: {name: href}}
+# With create_missing=False nothing is created (e.g. check mode) and the missing labels
+# get a placeholder href "new:<type>:<name>" instead
+def resolve_labels(creds, rows, labels_details=None, workers=DEFAULT_WORKERS, create_missing=True):
+    if labels_details is None:
+        labels_details = create_label_href_dict(creds)
+    wanted = set()
+    for row in rows:
+        for key in LABEL_TYPES:
+            if row.get(key):
+                wanted.add((key, row[key]))
+    missing = sorted(pair for pair in wanted if pair[1] not in labels_details[pair[0]])
+    if not create_missing:
+        for key, value in missing:
+            labels_details[key][value] = "new:{}:{}".format(key, value)
+        missing = []
+
+    responses = run_concurrently(lambda pair: create_label(creds, pair[0], pair[1]), missing,
+                                 workers_for(creds, workers))
+    for (key, value), response in zip(missing, responses):
+        if response.status_code != 201:
+            raise RuntimeError("Unable to create label {} : {} (HTTP {})".format(key, value, response.status_code))
+        labels_details[key][value] = decode(response)['href']
+
+    # Wait for the PCE to finish creating the new labels
+    # This is just a fail-safe
+    # Might not be necessary
+    if missing:
+        time.sleep(4.0)
+    return MappingProxyType(dict((key, MappingProxyType(dict(labels_details[key]))) for key in LABEL_TYPES))
+
+
+# Get the hrefs of the labels of a row from the table returned by resolve_labels
+# Types without a value in the row are skipped
+def label_hrefs(labels_table, row):
+    return [labels_table[key][row[key]] for key in LABEL_TYPES if row.get(key)]
+
+
+# Merge the rows (in input order) given for the same workload into a single row of labels
+# Returns the merged row and the conflicts: types given different non-empty values by the rows,
+# as "type: value1 / value2" strings
+def merge_label_rows(rows, merge='last_wins'):
+    if merge == 'last_wins':
+        merged = dict((key, rows[-1].get(key) or "") for key in LABEL_TYPES)
+    else:
+        merged = dict((key, next((row[key] for row in rows if row.get(key)), "")) for key in LABEL_TYPES)
+    conflicts = []
+    for key in LABEL_TYPES:
+        values = []
+        for row in rows:
+            if row.get(key) and row[key] not in values:
+                values.append(row[key])
+        if len(values) > 1:
+            conflicts.append("{}: {}".format(key, " / ".join(values)))
+    return merged, conflicts
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+"""
+Indexes to match input rows (e.g. csv rows) with workloads:
+- IP/CIDR index built from the workloads' interface addresses
+- Hostname index tolerant to case and FQDN vs short name differences
+"""
+
+__author__ = "Nghia Huu (David) Nguyen"
+__copyright__ = "Copyright 2021"
+__credits__ = ["David Nguyen"]
+__license__ = "GPL"
+__version__ = "1.0.0"
+__maintainer__ = "David Nguyen"
+__email__ = "davidnguyen0207@gmail.com"
+__status__ = "In Development"
+
+# Import required modules
+from bisect import bisect_left, bisect_right
+import ipaddress
+
+
+class IpIndex(object):
+
+    # Build the index from workload records holding "href" and "interfaces" (tuple of addresses)
+    # See workloads.compact_workloads
+    # Addresses are kept as sorted (IP version, integer) keys so any IP or subnet
+    # is found with two binary searches instead of a scan of every interface
+    def __init__(self, workloads_list):
+        entries = []
+        for workload in workloads_list:
+            for address in workload.interfaces or ():
+                try:
+                    ip = ipaddress.ip_address(address)
+                except ValueError:
+                    continue
+                entries.append(((ip.version, int(ip)), workload))
+        entries.sort(key=lambda entry: entry[0])
+        self.keys = [entry[0] for entry in entries]
+        self.workloads = [entry[1] for entry in entries]
+
+    # Get the workloads with an interface address in "value", a single IP or a subnet in CIDR notation
+    # Each workload is returned once, even if several of its addresses are in the subnet
+    # Returns an empty list if "value" is not a valid IP or subnet
+    def lookup(self, value):
+        try:
+            network = ipaddress.ip_network(value.strip(), strict=False)
+        except ValueError:
+            return []
+        start = bisect_left(self.keys, (network.version, int(network.network_address)))
+        end = bisect_right(self.keys, (network.version, int(network.broadcast_address)))
+        found = dict()
+        for workload in self.workloads[start:end]:
+            found.setdefault(workload.href, workload)
+        return list(found.values())
+
+
+# Add a workload to the bucket of a key
+def _add(index, key, workload):
+    index.setdefault(key, []).append(workload)
+
+
+# Remove duplicates (same href) from a bucket
+# Returns the workloads and whether more than one workload matched
+def _distinct(bucket):
+    found = dict()
+    for workload in bucket:
+        found.setdefault(workload.href, workload)
+    return list(found.values()), len(found) > 1
+
+
+class HostnameIndex(object):
+
+    # Build the index from workload records holding "href" and "hostname"
+    # Every workload is indexed under several keys, from the most to the least strict:
+    # - its exact hostname
+    # - its lowercase hostname, plus the FQDN/short name variants for the given domain suffixes
+    #   (e.g. with "corp.local", web01 is also indexed as web01.corp.local and the other way around)
+    # - its lowercase short name (hostname up to the first dot), whatever the domain
+    # Workloads without a domain in their hostname are also kept apart, to match FQDNs of any domain
+    def __init__(self, workloads_list, domain_suffixes=()):
+        self.suffixes = [suffix.strip(".").lower() for suffix in domain_suffixes or () if suffix.strip(".")]
+        self.exact = dict()
+        self.normalised = dict()
+        self.short = dict()
+        self.bare = dict()
+        for workload in workloads_list:
+            if not workload.hostname:
+                continue
+            _add(self.exact, workload.hostname, workload)
+            lower = workload.hostname.lower().rstrip(".")
+            for key in self._variants(lower):
+                _add(self.normalised, key, workload)
+            _add(self.short, lower.split(".")[0], workload)
+            if "." not in lower:
+                _add(self.bare, lower, workload)
+
+    # Lowercase hostname and its variants for the configured domain suffixes
+    def _variants(self, lower):
+        variants = [lower]
+        for suffix in self.suffixes:
+            if lower.endswith("." + suffix):
+                variants.append(lower[:-len(suffix) - 1])
+            elif "." not in lower:
+                variants.append(lower + "." + suffix)
+        return variants
+
+    # Get the workloads matching a hostname, using the strictest key that matches
+    # An exact match returns every workload with that hostname (same behaviour as comparing strings)
+    # A short name falls back to workloads of any domain with that short name,
+    # an FQDN falls back to workloads without a domain (but never to another domain's FQDN)
+    # A normalised match is ambiguous when it finds more than one workload
+    # Returns the workloads and whether the match is ambiguous
+    def lookup(self, value):
+        if value in self.exact:
+            return list(self.exact[value]), False
+        lower = value.lower().rstrip(".")
+        for key in self._variants(lower):
+            if key in self.normalised:
+                return _distinct(self.normalised[key])
+        if "." not in lower:
+            return _distinct(self.short.get(lower, []))
+        return _distinct(self.bare.get(lower.split(".")[0], []))
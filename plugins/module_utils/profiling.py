@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+"""
+Opt-in profiling of module runs:
+- Run a module under cProfile when ILLUMIO_PROFILE is set
+- Write the profile file and add a top-N summary to the module's result
+"""
+
+__author__ = "Nghia Huu (David) Nguyen"
+__copyright__ = "Copyright 2021"
+__credits__ = ["David Nguyen"]
+__license__ = "GPL"
+__version__ = "1.0.0"
+__maintainer__ = "David Nguyen"
+__email__ = "davidnguyen0207@gmail.com"
+__status__ = "In Development"
+
+# Import required modules
+from ansible.module_utils.basic import AnsibleModule
+import os
+
+# Environment variable enabling the profiler
+# Path of the profile file to write, or of a directory to write <module>-<pid>.prof files in
+PROFILE_ENV = "ILLUMIO_PROFILE"
+# Environment variable setting the number of functions in the summary (default 20)
+PROFILE_TOP_ENV = "ILLUMIO_PROFILE_TOP"
+
+
+# Write the profile file and summarise the functions with the highest cumulative time
+# The file can be opened with pstats, snakeviz,...
+def _summary(profiler, path, top):
+    import pstats
+    profiler.dump_stats(path)
+    stats = pstats.Stats(profiler).stats
+    functions = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+    return dict(
+        file=path,
+        total_time=round(sum(stat[2] for stat in stats.values()), 6),
+        top=[dict(function="{}:{}({})".format(*function),
+                  calls=stat[1],
+                  own_time=round(stat[2], 6),
+                  cumulative_time=round(stat[3], 6)) for function, stat in functions],
+    )
+
+
+# Run a module's run_module() function, under cProfile if ILLUMIO_PROFILE is set
+# exit_json/fail_json are wrapped for the duration of the run, so the profile is written
+# and its summary is added to the result (under "profile") whichever way the module exits
+# cProfile and pstats are only imported when profiling
+def run_profiled(run_module, name):
+    path = os.environ.get(PROFILE_ENV)
+    if not path:
+        return run_module()
+    import cProfile
+    if os.path.isdir(path):
+        path = os.path.join(path, "{}-{}.prof".format(name, os.getpid()))
+    top = int(os.environ.get(PROFILE_TOP_ENV) or 20)
+    profiler = cProfile.Profile()
+    original_exit_json = AnsibleModule.exit_json
+    original_fail_json = AnsibleModule.fail_json
+
+    def finish(method):
+        def wrapper(self, **kwargs):
+            profiler.disable()
+            kwargs['profile'] = _summary(profiler, path, top)
+            return method(self, **kwargs)
+        return wrapper
+
+    AnsibleModule.exit_json = finish(original_exit_json)
+    AnsibleModule.fail_json = finish(original_fail_json)
+    profiler.enable()
+    try:
+        return run_module()
+    finally:
+        profiler.disable()
+        AnsibleModule.exit_json = original_exit_json
+        AnsibleModule.fail_json = original_fail_json
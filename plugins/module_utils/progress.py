@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+"""
+Progress of long module runs:
+- Split a run into phases (e.g. fetch, resolve, write) and time them
+- Count rows processed and writes sent, estimate the time left from the measured throughput
+- Write it all to a progress file that can be read while the module runs (e.g. under Ansible async)
+"""
+
+__author__ = "Nghia Huu (David) Nguyen"
+__copyright__ = "Copyright 2021"
+__credits__ = ["David Nguyen"]
+__license__ = "GPL"
+__version__ = "1.0.0"
+__maintainer__ = "David Nguyen"
+__email__ = "davidnguyen0207@gmail.com"
+__status__ = "In Development"
+
+# Import required modules
+from ansible_collections.respiro.illumio.plugins.module_utils.api_calls import dumps
+from collections import OrderedDict
+import os
+import time
+import tempfile
+import threading
+
+# Minimum time (in seconds) between two writes of the progress file
+WRITE_INTERVAL = 1.0
+
+
+class ProgressFile(object):
+
+    # Progress file at "path", holding the progress of every target of the run
+    # Without a path, progress is still measured (for the module's result) but not written
+    def __init__(self, path=None, interval=WRITE_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.trackers = OrderedDict()
+        self.lock = threading.Lock()
+        self.last_write = 0.0
+
+    # Get the progress of a credential's PCE/org, created on first use
+    def tracker(self, creds):
+        name = "{}:{}{}".format(creds.pce, creds.port, creds.org_href)
+        with self.lock:
+            if name not in self.trackers:
+                self.trackers[name] = Progress(self)
+            return self.trackers[name]
+
+    # Write the progress of every target, at most once per interval unless forced
+    # The file is replaced atomically so readers never see a partial file
+    def write(self, force=False):
+        if not self.path:
+            return
+        with self.lock:
+            now = time.time()
+            if not force and now - self.last_write < self.interval:
+                return
+            self.last_write = now
+            state = dict(updated=now, targets=OrderedDict((name, tracker.state(now))
+                                                          for name, tracker in self.trackers.items()))
+            data = dumps(state)
+            if not isinstance(data, bytes):
+                data = data.encode("utf-8")
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".progress-")
+            with os.fdopen(fd, "wb") as tmp:
+                tmp.write(data)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.path)
+
+
+class Progress(object):
+
+    # Progress of a run against a single PCE/org, reported through its progress file
+    def __init__(self, report):
+        self.report = report
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # Finished phases as (name, seconds, rows or writes done)
+        self.phases = []
+        self.phase_name = None
+        self.phase_unit = "rows"
+        self.phase_started = self.started
+        self.phase_total = None
+        self.phase_done = 0
+        self.rows_total = None
+        self.rows_processed = 0
+        self.writes_sent = 0
+
+    # Start a phase, finishing the previous one
+    # The phase counts "rows" or "writes", "total" is the number of them it will process, if known
+    def phase(self, name, total=None, unit="rows"):
+        with self.lock:
+            now = time.time()
+            self._finish_phase(now)
+            self.phase_name = name
+            self.phase_unit = unit
+            self.phase_started = now
+            self.phase_total = total
+            self.phase_done = 0
+        self.report.write(force=True)
+
+    def _finish_phase(self, now):
+        if self.phase_name is not None:
+            self.phases.append((self.phase_name, now - self.phase_started, self.phase_done))
+
+    # Set the number of rows of the input
+    def set_rows(self, total):
+        self.rows_total = total
+
+    # Count rows processed and writes sent, the current phase counts the ones of its unit
+    # Safe to call from concurrent threads
+    def advance(self, rows=0, writes=0):
+        with self.lock:
+            self.rows_processed += rows
+            self.writes_sent += writes
+            self.phase_done += rows if self.phase_unit == "rows" else writes
+        self.report.write()
+
+    # Snapshot of the progress
+    # The time left is estimated from the throughput of the current phase, when its total is known
+    def state(self, now=None):
+        now = now or time.time()
+        with self.lock:
+            phase_elapsed = now - self.phase_started
+            rate = self.phase_done / phase_elapsed if phase_elapsed > 0 else 0.0
+            eta = None
+            if self.phase_total is not None and rate > 0:
+                eta = round(max(self.phase_total - self.phase_done, 0) / rate, 1)
+            return dict(phase=self.phase_name,
+                        phase_unit=self.phase_unit,
+                        phase_done=self.phase_done,
+                        phase_total=self.phase_total,
+                        rows_total=self.rows_total,
+                        rows_processed=self.rows_processed,
+                        writes_sent=self.writes_sent,
+                        items_per_second=round(rate, 2),
+                        eta_seconds=eta,
+                        elapsed_seconds=round(now - self.started, 1),
+                        phases=[dict(name=name, seconds=round(seconds, 3), done=done)
+                                for name, seconds, done in self.phases])
+
+    # Finish the run and write the final progress
+    # Returns the timing of the run, to be added to the module's result
+    def finish(self):
+        with self.lock:
+            now = time.time()
+            self._finish_phase(now)
+            self.phase_name = "done"
+            self.phase_started = now
+            self.phase_total = None
+            self.phase_done = 0
+            timing = dict(elapsed_seconds=round(now - self.started, 3),
+                          rows_processed=self.rows_processed,
+                          writes_sent=self.writes_sent,
+                          phases=OrderedDict((name, dict(seconds=round(seconds, 3), done=done,
+                                                         per_second=round(done / seconds, 2) if seconds > 0 else None))
+                                             for name, seconds, done in self.phases))
+        self.report.write(force=True)
+        return timing
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+"""
+Compact module results for large runs:
+- Replace the per-item lists of a result by their count and a bounded sample
+- Write the full per-item outcomes to a gzip-compressed JSON lines file
+- Digest of the full outcomes, to compare runs without the items
+"""
+
+__author__ = "Nghia Huu (David) Nguyen"
+__copyright__ = "Copyright 2021"
+__credits__ = ["David Nguyen"]
+__license__ = "GPL"
+__version__ = "1.0.0"
+__maintainer__ = "David Nguyen"
+__email__ = "davidnguyen0207@gmail.com"
+__status__ = "In Development"
+
+# Import required modules
+from ansible_collections.respiro.illumio.plugins.module_utils.api_calls import dumps
+from itertools import islice
+import os
+import gzip
+import time
+import hashlib
+import tempfile
+
+# Ways a module can return its per-item outcomes
+# summary: counts, a sample and a digest, the items go to the result file
+# full: every item in the result, as before
+RESULT_MODES = ('summary', 'full')
+# Default number of items kept in each sample
+SAMPLE_SIZE = 20
+
+
+# Default path of a module's result file, in the temp directory
+def result_file_path(name):
+    return os.path.join(tempfile.gettempdir(), "respiro_illumio_{}_{}_{}.jsonl.gz".format(
+        name, time.strftime("%Y%m%dT%H%M%S"), os.getpid()))
+
+
+# Make sure a result file can be written before the run starts, creating its directory if needed
+# Raises IOError/OSError if it can't, so a module can fail before making any change
+def prepare_result_file(path):
+    if not path:
+        return
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if not os.access(directory, os.W_OK | os.X_OK):
+        raise IOError("Directory {} is not writable".format(directory))
+
+
+# Replace the lists (or dicts) of a result under "keys" by {"count": ..., "sample": ...}
+# Returns one record per item removed, {"result": key, "item": item} (plus "detail" for dicts and the tags)
+def summarise(result, keys, sample_size=SAMPLE_SIZE, tags=None):
+    records = []
+    for key in keys:
+        items = result.get(key)
+        if items is None:
+            continue
+        if isinstance(items, dict):
+            records.extend(dict(tags or dict(), result=key, item=item, detail=detail) for item, detail in items.items())
+            sample = dict(islice(items.items(), sample_size))
+        else:
+            records.extend(dict(tags or dict(), result=key, item=item) for item in items)
+            sample = list(items[:sample_size])
+        result[key] = dict(count=len(items), sample=sample)
+    return records
+
+
+# Write the records as gzip-compressed JSON lines, replacing the file atomically
+# The file is only readable by its owner, it can hold hostnames and label names
+# Returns the sha256 of the uncompressed lines
+def write_result_file(path, records):
+    digest = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".results-")
+    with os.fdopen(fd, "wb") as tmp:
+        with gzip.GzipFile(fileobj=tmp, mode="wb") as compressed:
+            for record in records:
+                line = dumps(record)
+                if not isinstance(line, bytes):
+                    line = line.encode("utf-8")
+                line += b"\n"
+                digest.update(line)
+                compressed.write(line)
+    os.chmod(tmp_path, 0o600)
+    os.replace(tmp_path, path)
+    return digest.hexdigest()
+
+
+# Summarise the results of a module (one per target) and write their items to the result file
+# Records of results tagged with a pce/org_href (see concurrency.fan_out) carry the same tags
+# The results are only summarised once the file is written: if writing fails (IOError/OSError is raised),
+# they still hold every item and can be returned as they are
+# Returns the entries to add to the module's result: result_file and digest
+def summarise_results(results, keys, path=None, name="results", sample_size=SAMPLE_SIZE):
+    records = []
+    summaries = []
+    for result in results:
+        tags = dict((tag, result[tag]) for tag in ('pce', 'org_href') if tag in result)
+        summary = dict(result)
+        records.extend(summarise(summary, keys, sample_size, tags))
+        summaries.append(summary)
+    path = path or result_file_path(name)
+    digest = write_result_file(path, records)
+    for result, summary in zip(results, summaries):
+        result.update(summary)
+    return dict(result_file=path, digest=digest)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+"""
+Local snapshots of PCE objects kept up to date with deltas:
+- Load and save a snapshot file
+- Get the events that happened on the PCE since a point in time
+- Bring a snapshot up to date using the events feed (full export when there is no usable snapshot)
+"""
+
+__author__ = "Nghia Huu (David) Nguyen"
+__copyright__ = "Copyright 2021"
+__credits__ = ["David Nguyen"]
+__license__ = "GPL"
+__version__ = "1.0.0"
+__maintainer__ = "David Nguyen"
+__email__ = "davidnguyen0207@gmail.com"
+__status__ = "In Development"
+
+# Import required modules
+from ansible_collections.respiro.illumio.plugins.module_utils.api_calls import sync_api, async_api, decode, \
+    loads, dumps
+from ansible_collections.respiro.illumio.plugins.module_utils.concurrency import run_concurrently, workers_for
+import os
+import time
+import tempfile
+
+# Version of the snapshot file format
+SNAPSHOT_VERSION = 1
+# Above this number of changed objects, a full export is cheaper than fetching them one by one
+MAX_DELTA_OBJECTS = 500
+# Snapshots older than this (in seconds) are refreshed with a full export
+# Catches changes that never show up in the events feed
+MAX_SNAPSHOT_AGE = 7 * 24 * 3600
+
+
+# Path of the snapshot file of a resource (e.g. "workloads") for a credential's PCE and org
+def snapshot_path(directory, creds, resource):
+    org_id = creds.org_href.rstrip("/").split("/")[-1]
+    return os.path.join(directory, "{}_{}_{}_{}.json".format(creds.pce, creds.port, org_id, resource))
+
+
+# Read a snapshot file
+# Returns None if the file is missing, unreadable or was taken from another PCE/org
+def load_snapshot(path, creds):
+    try:
+        with open(path, "rb") as snapshot_file:
+            snapshot = loads(snapshot_file.read())
+    except (IOError, OSError, ValueError):
+        return None
+    if snapshot.get("version") != SNAPSHOT_VERSION or snapshot.get("pce") != creds.pce \
+            or snapshot.get("org_href") != creds.org_href:
+        return None
+    return snapshot
+
+
+# Write a snapshot file atomically so a concurrent reader never sees a half written file
+def save_snapshot(path, snapshot):
+    directory = os.path.dirname(path) or "."
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    data = dumps(snapshot)
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, "wb") as tmp_file:
+        tmp_file.write(data)
+    os.chmod(tmp_path, 0o600)
+    os.rename(tmp_path, path)
+
+
+# Get the events that happened on the PCE since the timestamp (ISO 8601, inclusive)
+# Will use async request if the data set has >500 items
+def get_events(creds, since):
+    response = sync_api(creds, "get", "/events?max_result=1&timestamp[gte]=" + since, True)
+    num_items_in_return_set = int(response.headers['X-Total-Count'])
+    if num_items_in_return_set >= 500:
+        response = async_api(creds, "/events?timestamp[gte]=" + since, True)
+    return decode(response)
+
+
+# Find the objects of a type ("workload", "label") changed by the events
+# Returns the latest event timestamp, the hrefs that were created/updated and the hrefs that were deleted
+# An href is only reported once, under the last change made to it
+def changed_hrefs(events, object_type, high_water_mark):
+    last_change = dict()
+    for event in sorted(events, key=lambda event: event.get('timestamp', "")):
+        if event.get('status') not in (None, "success"):
+            continue
+        high_water_mark = max(high_water_mark, event.get('timestamp', ""))
+        for change in event.get('resource_changes') or []:
+            resource = (change.get('resource') or dict()).get(object_type)
+            if resource and resource.get('href'):
+                last_change[resource['href']] = change.get('change_type')
+    updated = [href for href, change_type in last_change.items() if change_type != "delete"]
+    deleted = [href for href, change_type in last_change.items() if change_type == "delete"]
+    return high_water_mark, updated, deleted
+
+
+# Take a new snapshot with a full export
+# The high-water mark is the latest updated_at of the exported objects
+def _full_snapshot(creds, fetch_all):
+    objects = fetch_all(creds)
+    return {
+        "version": SNAPSHOT_VERSION,
+        "pce": creds.pce,
+        "org_href": creds.org_href,
+        "taken_at": time.time(),
+        "high_water_mark": max([obj.get('updated_at') or "" for obj in objects] or [""]),
+        "objects": dict((obj['href'], obj) for obj in objects),
+    }
+
+
+# Bring the snapshot of a type of object up to date and return the objects as a list
+# fetch_all(creds) does a full export, object_type is the resource name used in events ("workload", "label")
+# Only the objects changed since the snapshot's high-water mark are fetched,
+# a full export is only done when there is no usable snapshot or the delta is too large
+def sync_snapshot(creds, path, object_type, fetch_all):
+    snapshot = load_snapshot(path, creds)
+    if snapshot is None or not snapshot["high_water_mark"] \
+            or time.time() - snapshot["taken_at"] > MAX_SNAPSHOT_AGE:
+        snapshot = _full_snapshot(creds, fetch_all)
+    else:
+        events = get_events(creds, snapshot["high_water_mark"])
+        high_water_mark, updated, deleted = changed_hrefs(events, object_type, snapshot["high_water_mark"])
+        if len(updated) > MAX_DELTA_OBJECTS:
+            snapshot = _full_snapshot(creds, fetch_all)
+        else:
+            responses = run_concurrently(lambda href: sync_api(creds, "get", href, False), updated, workers_for(creds))
+            for href, response in zip(updated, responses):
+                if response.status_code == 200:
+                    snapshot["objects"][href] = decode(response)
+                elif response.status_code == 404:
+                    deleted.append(href)
+                else:
+                    raise RuntimeError("Unable to get {} from the PCE (HTTP {})".format(href, response.status_code))
+            for href in deleted:
+                snapshot["objects"].pop(href, None)
+            snapshot["high_water_mark"] = high_water_mark
+    save_snapshot(path, snapshot)
+    return list(snapshot["objects"].values())
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+"""
+Minimal HTTP transport built on the standard library (http.client), for the "stdlib" transport:
+- Keep-alive connections, one per thread and PCE
+- Basic authentication, gzip/deflate decompression
+- Responses with the parts of requests' Response used by this collection
+Nothing outside the standard library is imported, so modules using it start faster
+"""
+
+__author__ = "Nghia Huu (David) Nguyen"
+__copyright__ = "Copyright 2021"
+__credits__ = ["David Nguyen"]
+__license__ = "GPL"
+__version__ = "1.0.0"
+__maintainer__ = "David Nguyen"
+__email__ = "davidnguyen0207@gmail.com"
+__status__ = "In Development"
+
+# Import required modules
+import ssl
+import zlib
+import base64
+import threading
+import http.client
+from urllib.parse import urlsplit
+
+# Errors of a reused keep-alive connection the PCE has already closed, the request is sent again once
+_STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                            http.client.ResponseNotReady, ConnectionResetError, BrokenPipeError)
+
+
+class StdlibResponse(object):
+
+    # Wrap an http.client response
+    # The body is only read when content (or iter_content) is used
+    def __init__(self, response, url):
+        self.raw = response
+        self.url = url
+        self.status_code = response.status
+        self.headers = response.headers
+        self._content = None
+
+    # Yield the decompressed body in chunks of (at most) chunk_size bytes read from the connection
+    def iter_content(self, chunk_size=1024 * 1024):
+        encoding = (self.headers.get("Content-Encoding") or "").lower()
+        # gzip or zlib headers are detected automatically
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32) if encoding in ("gzip", "deflate") else None
+        while True:
+            chunk = self.raw.read(chunk_size)
+            if not chunk:
+                break
+            if decompressor:
+                chunk = decompressor.decompress(chunk)
+            if chunk:
+                yield chunk
+        if decompressor:
+            tail = decompressor.flush()
+            if tail:
+                yield tail
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = b"".join(self.iter_content())
+        return self._content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+
+class StdlibSession(object):
+
+    # Session sending requests with basic authentication
+    # http.client connections can't be shared by threads, so every thread keeps its own ones
+    def __init__(self, username, auth_secret):
+        token = base64.b64encode("{}:{}".format(username, auth_secret).encode("utf-8")).decode("ascii")
+        self.authorization = "Basic " + token
+        self.context = ssl.create_default_context()
+        self.local = threading.local()
+
+    # Get this thread's connection to a host, opened on first use
+    def _connection(self, scheme, netloc, timeout, fresh=False):
+        connections = self.local.__dict__.setdefault("connections", dict())
+        connection = connections.get((scheme, netloc))
+        if connection is not None and fresh:
+            connection.close()
+            connection = None
+        if connection is None:
+            if scheme == "https":
+                connection = http.client.HTTPSConnection(netloc, timeout=timeout, context=self.context)
+            else:
+                connection = http.client.HTTPConnection(netloc, timeout=timeout)
+            connections[(scheme, netloc)] = connection
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        return connection
+
+    # Send a request, same arguments as requests.Session.request
+    # Unless stream=True, the body is read straight away so the connection can be reused
+    def request(self, http_verb, url, headers=None, timeout=None, data=None, stream=False):
+        parts = urlsplit(url)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        headers = dict(headers or dict(), Authorization=self.authorization)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        for attempt in (1, 2):
+            connection = self._connection(parts.scheme, parts.netloc, timeout, fresh=attempt > 1)
+            try:
+                connection.request(http_verb.upper(), path, body=data, headers=headers)
+                response = StdlibResponse(connection.getresponse(), url)
+                break
+            except _STALE_CONNECTION_ERRORS:
+                connection.close()
+                if attempt > 1:
+                    raise
+        if not stream:
+            response.content
+        return response
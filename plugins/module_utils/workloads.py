@@ -3,8 +3,12 @@
 """
 Operations with workloads:
 - Get workloads
+- Get workloads as compact records holding only the requested fields
+- Export workloads in parallel, disjoint slices
+- Keep a local snapshot of the workloads up to date with the changes made since the last run
 - Update a workload's details
 - Create unmanaged workload
+- Create or update unmanaged workloads in bulk
 """
 
 __author__ = "Nghia Huu (David) Nguyen"
@@ -17,41 +21,143 @@ __email__ = "davidnguyen0207@gmail.com"
 __status__ = "In Development"
 
 # Import required modules
-from ansible_collections.respiro.illumio.plugins.module_utils.api_calls import sync_api, async_api
+from ansible_collections.respiro.illumio.plugins.module_utils.api_calls import sync_api, async_api, decode, \
+    iter_json_array, forget_async_jobs
+from ansible_collections.respiro.illumio.plugins.module_utils.snapshot import snapshot_path, sync_snapshot
+from ansible_collections.respiro.illumio.plugins.module_utils.concurrency import DEFAULT_WORKERS, run_concurrently, \
+    workers_for
+from ansible_collections.respiro.illumio.plugins.module_utils.cache_client import query_cache, invalidate_cache
+from collections import namedtuple
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+# Fields needed to match workloads and change their labels
+LABEL_FIELDS = ('href', 'hostname', 'labels')
+# Fields needed to compare unmanaged workloads with their expected state
+UMW_FIELDS = ('href', 'hostname', 'public_ip', 'interfaces', 'labels')
+# Maximum number of workloads the PCE accepts in a single bulk request
+BULK_SIZE = 1000
+# Built-in partitions of the workloads, each one a list of disjoint query parameters covering all workloads
+PARTITIONS = {
+    'managed': [{"managed": "true"}, {"managed": "false"}],
+}
+
+# Fields that are reduced to something smaller when projected:
+# labels become a tuple of label hrefs, interfaces a tuple of IP addresses
+_CONVERTERS = {
+    'labels': lambda labels: tuple(label['href'] for label in labels or ()),
+    'interfaces': lambda interfaces: tuple(interface['address'] for interface in interfaces or ()
+                                           if interface.get('address')),
+}
+
+# Record types already created, one per set of fields
+_RECORD_TYPES = dict()
 
 
 # Get all workloads from PCE
 # Required credential
-def get_workloads(creds):
-    response = sync_api(creds, "get", "/workloads?max_result=1", True)
+# Optional query parameters (e.g. {"managed": "false"}) are passed on to the PCE
+def get_workloads(creds, params=None):
+    query = urlencode(sorted(params.items())) if params else ""
+    response = sync_api(creds, "get", "/workloads?max_result=1" + ("&" + query if query else ""), True)
     num_items_in_return_set = int(response.headers['X-Total-Count'])
     if num_items_in_return_set >= 500:
-        response = async_api(creds, "/workloads", True)
+        response = async_api(creds, "/workloads" + ("?" + query if query else ""), True)
     return response
 
 
+# Get the record type holding the given fields
+# Records are named tuples: no per-object dict, fields are read as attributes (e.g. workload.href)
+def workload_record_type(fields):
+    fields = tuple(fields)
+    if fields not in _RECORD_TYPES:
+        _RECORD_TYPES[fields] = namedtuple('Workload', fields)
+    return _RECORD_TYPES[fields]
+
+
+# Convert workloads (dicts as returned by the PCE) into compact records
+# Only the requested fields are kept, missing fields are set to None
+def compact_workloads(workloads_list, fields=LABEL_FIELDS):
+    record = workload_record_type(fields)
+    converters = [_CONVERTERS.get(field) for field in fields]
+    records = []
+    for workload in workloads_list:
+        values = []
+        for field, converter in zip(fields, converters):
+            value = workload.get(field)
+            values.append(converter(value) if converter else value)
+        records.append(record(*values))
+    return records
+
+
+# Get all workloads from PCE as a list
+# If fields are given, every workload is converted into a compact record holding only those fields
+# The PCE has no field selection for workloads, so the projection is done while decoding:
+# workloads are decoded one by one and converted straight away
+# Without query parameters, the workloads come from the controller's cache if it's running
+# With partitions, the export is split into slices fetched in parallel (see fetch_partitioned_workloads)
+def fetch_workloads(creds, fields=None, params=None, partitions=None, workers=DEFAULT_WORKERS):
+    if not params:
+        workloads_list = query_cache(creds, "workloads")
+        if workloads_list is not None:
+            return workloads_list if fields is None else compact_workloads(workloads_list, fields)
+    if partitions:
+        return fetch_partitioned_workloads(creds, partitions, fields, params, workers)
+    response = get_workloads(creds, params)
+    if fields is None:
+        return decode(response)
+    return compact_workloads(iter_json_array(response.text), fields)
+
+
+# Get all workloads from PCE as a list, exported in slices
+# "partitions" is the name of a built-in partition (see PARTITIONS) or a list of query parameters, one per slice
+# Each slice is its own request (or asynchronous job), up to "workers" slices are fetched at the same time
+# Slices are merged and workloads found in several slices (overlapping queries) are only kept once
+def fetch_partitioned_workloads(creds, partitions, fields=None, params=None, workers=DEFAULT_WORKERS):
+    slices = PARTITIONS[partitions] if isinstance(partitions, str) else partitions
+    slices = [dict(params or dict(), **query) for query in slices]
+    results = run_concurrently(lambda query: fetch_workloads(creds, fields, query), slices, workers_for(creds, workers))
+    merged = dict()
+    for workloads_list in results:
+        for workload in workloads_list:
+            merged.setdefault(workload['href'] if fields is None else workload.href, workload)
+    return list(merged.values())
+
+
+# Get all workloads from PCE as a list, from a local snapshot kept in "directory"
+# Only the workloads changed since the last run are fetched from the PCE
+# Falls back to a full export when there is no usable snapshot
+# If fields are given, workloads are returned as compact records (see fetch_workloads)
+def sync_workloads(creds, directory, fields=None):
+    workloads_list = sync_snapshot(creds, snapshot_path(directory, creds, "workloads"), "workload", fetch_workloads)
+    if fields is None:
+        return workloads_list
+    return compact_workloads(workloads_list, fields)
+
+
+# After a write to the workloads, stop serving copies of the workloads made before it:
+# exports started before the write are no longer shared and the controller's cache is invalidated
+def _workloads_written(creds):
+    forget_async_jobs(creds, "/workloads")
+    invalidate_cache(creds, "workloads")
+
+
 # Update workload's details
 # Required credential, the href of the target workload
 # And the payload containing the information that needs to be changed
 def update_workload(creds, workload_href, payload):
-    return sync_api(creds, "put", workload_href, False, payload)
+    response = sync_api(creds, "put", workload_href, False, payload)
+    _workloads_written(creds)
+    return response
 
 
-# Create unmanaged workload
-# Required a credential, name (display on PCE)
-# A hostname, an IP
-# And a set of label associated with the machine
-def create_umw(creds, name, hostname, ip, label1=None, label2=None, label3=None, label4=None):
-    label = []
-    if label1:
-        label.append({"href": label1})
-    if label2:
-        label.append({"href": label2})
-    if label3:
-        label.append({"href": label3})
-    if label4:
-        label.append({"href": label4})
-    wl = {
+# Build the details of an unmanaged workload
+# Required a name (display on PCE), a hostname, an IP
+# And the hrefs of the labels associated with the machine
+def umw_payload(name, hostname, ip, label_hrefs):
+    return {
         "name": name,
         "hostname": hostname,
         "public_ip": ip,
@@ -61,6 +167,50 @@ def create_umw(creds, name, hostname, ip, label1=None, label2=None, label3=None,
               "cidr_block": 32,
               "link_state": "up"}],
         "online": True,
-        "labels": label
+        "labels": [{"href": href} for href in label_hrefs if href]
     }
-    return sync_api(creds, "post", "/workloads", True, wl)
+
+
+# Create unmanaged workload
+# Required a credential, name (display on PCE)
+# A hostname, an IP
+# And a set of label associated with the machine
+def create_umw(creds, name, hostname, ip, label1=None, label2=None, label3=None, label4=None):
+    wl = umw_payload(name, hostname, ip, [label1, label2, label3, label4])
+    response = sync_api(creds, "post", "/workloads", True, wl)
+    _workloads_written(creds)
+    return response
+
+
+# Send workloads to a bulk endpoint ("bulk_create" or "bulk_update") in batches of BULK_SIZE
+# Batches are sent concurrently, on_batch (if any) is called with the size of every batch sent
+# Returns the per-workload results reported by the PCE
+def _bulk_workloads(creds, operation, workloads_list, workers, on_batch=None):
+    def send(batch):
+        response = sync_api(creds, "put", "/workloads/" + operation, True, batch)
+        if on_batch:
+            on_batch(len(batch))
+        return response
+
+    batches = [workloads_list[i:i + BULK_SIZE] for i in range(0, len(workloads_list), BULK_SIZE)]
+    responses = run_concurrently(send, batches, workers_for(creds, workers))
+    if batches:
+        _workloads_written(creds)
+    results = []
+    for response in responses:
+        if response.status_code != 200:
+            raise RuntimeError("Workloads {} failed (HTTP {})".format(operation, response.status_code))
+        results.extend(decode(response))
+    return results
+
+
+# Create unmanaged workloads in bulk
+# Required a credential and the details of the workloads (see umw_payload)
+def bulk_create_workloads(creds, workloads_list, workers=DEFAULT_WORKERS, on_batch=None):
+    return _bulk_workloads(creds, "bulk_create", workloads_list, workers, on_batch)
+
+
+# Update workloads in bulk
+# Required a credential and the changes to make, each one containing the href of its workload
+def bulk_update_workloads(creds, workloads_list, workers=DEFAULT_WORKERS, on_batch=None):
+    return _bulk_workloads(creds, "bulk_update", workloads_list, workers, on_batch)
@@ -23,17 +23,122 @@ options:
         required: true
         type: str
     pce:
-        description: This takes the url link to Illumio PCE
-        required: true
+        description: This takes the url link to Illumio PCE. Required unless targets is given
+        required: false
         type: str
     org_id:
-        description: This takes the organisation ID for Illumio PCE
-        required: true
+        description: This takes the organisation ID for Illumio PCE. Required unless targets is given
+        required: false
+        type: str
+    targets:
+        description:
+            - List of PCE/org targets to run against at the same time, instead of pce and org_id
+            - Each target takes pce, org_id and optionally port, username and auth_secret
+            - username, auth_secret default to the top-level values, port defaults to 443
+        required: false
+        type: list
+        elements: dict
+    rate_limit:
+        description: Maximum number of requests per second sent to each PCE
+        required: false
+        type: float
+    transport:
+        description:
+            - HTTP transport used to reach the PCE
+            - http1 opens one connection per request in flight
+            - http2 multiplexes the requests in flight over a single connection, which helps with proxies limiting
+              the number of connections; requires the httpx and h2 Python packages
+            - stdlib only uses the Python standard library (no requests import), the quickest to start for small runs
+        required: false
         type: str
+        choices: ['http1', 'http2', 'stdlib']
+        default: http1
+    concurrency:
+        description:
+            - fixed sends a fixed number of requests at the same time
+            - adaptive starts low and raises the number of requests in flight while the PCE's p95 latency stays
+              healthy, and halves it on HTTP 429/503, timeouts, connection errors or rising latency (AIMD)
+            - With adaptive, the limit reached is returned under concurrency
+        required: false
+        type: str
+        choices: ['fixed', 'adaptive']
+        default: fixed
     workload:
         description: This takes the path to csv file containing workload information
         required: true
         type: str
+    snapshot_dir:
+        description:
+            - Directory where local snapshots of the PCE's labels and workloads are kept between runs
+            - When set, only the objects changed since the last run are fetched (using the PCE events feed)
+              instead of exporting the whole inventory
+        required: false
+        type: str
+    partition:
+        description:
+            - Export the workloads in slices fetched in parallel instead of one export
+            - managed splits the export into managed and unmanaged workloads
+            - Not used with snapshot_dir
+        required: false
+        type: str
+        choices: ['managed']
+    merge:
+        description:
+            - How the rows for the same workload are merged, the workload is then updated once with the result
+            - last_wins takes all the labels from the last row
+            - fill takes each label type from the first row that has a value for it
+            - Rows giving different values for the same label type are reported in conflicts
+        required: false
+        type: str
+        choices: ['last_wins', 'fill']
+        default: last_wins
+    match:
+        description:
+            - How the rows of the csv file are matched with workloads
+            - hostname matches the hostname column with the workloads' hostname, ignoring case and falling back
+              to the short name (and the domain_suffixes) when there is no exact match
+            - ip and cidr match the ip (single address) or cidr (subnet) column with the workloads' interface
+              addresses; a subnet assigns the labels to every workload with an address inside it
+        required: false
+        type: str
+        choices: ['hostname', 'ip', 'cidr']
+        default: hostname
+    domain_suffixes:
+        description:
+            - Domain suffixes (e.g. corp.local) used to match short hostnames with FQDNs and the other way around
+            - A row that matches several workloads this way is not assigned and is reported in ambiguous
+        required: false
+        type: list
+        elements: str
+    result_mode:
+        description:
+            - summary returns, for labels_assigned, not_assigned, ambiguous and conflicts, their count and a sample
+              of sample_size items, and writes every item to result_file (gzip-compressed JSON lines)
+              with a digest of its content, so the result stays small whatever the size of the csv file
+            - full returns every item in the result
+        required: false
+        type: str
+        choices: ['summary', 'full']
+        default: summary
+    result_file:
+        description:
+            - Path of the file the items are written to in summary mode, on the machine running the module
+              (run the task on the controller, e.g. delegate_to localhost, to keep it there)
+            - Defaults to a new respiro_illumio_assign_labels_<time>_<pid>.jsonl.gz file in the temp directory
+        required: false
+        type: str
+    sample_size:
+        description: Number of items kept in each sample in summary mode
+        required: false
+        type: int
+        default: 20
+    progress_file:
+        description:
+            - Path of a JSON file updated while the module runs, for long runs started with Ansible async
+            - Holds, per PCE/org, the current phase (fetch, resolve, write), rows processed, writes sent,
+              throughput and estimated time left of the phase
+        required: false
+        type: str
 
 author:
     - Safal Khanal (@Safalkhanal)
@@ -48,6 +153,47 @@ EXAMPLES = r'''
     pce: "poc1.illum.io"
     org_id: "85"
     workload: 'workload.csv'
+
+- name: Assign labels to every workload in the subnets of the csv file (cidr column)
+  respiro.illumio.assign_labels:
+    username: "testusername"
+    auth_secret: "testpassword"
+    pce: "poc1.illum.io"
+    org_id: "85"
+    workload: 'subnets.csv'
+    match: cidr
+
+- name: Assign the same labels on several PCEs at once
+  respiro.illumio.assign_labels:
+    username: "testusername"
+    auth_secret: "testpassword"
+    targets:
+      - pce: "poc1.illum.io"
+        org_id: "85"
+      - pce: "poc2.illum.io"
+        org_id: "12"
+        port: "8443"
+    workload: 'workload.csv'
+
+- name: Assign labels in the background, progress is written to a file while it runs
+  respiro.illumio.assign_labels:
+    username: "testusername"
+    auth_secret: "testpassword"
+    pce: "poc1.illum.io"
+    org_id: "85"
+    workload: 'workload.csv'
+    progress_file: '/tmp/assign_labels_progress.json'
+  async: 14400
+  poll: 0
+  register: assign_job
+
+- name: Wait for the labels to be assigned
+  ansible.builtin.async_status:
+    jid: "{{ assign_job.ansible_job_id }}"
+  register: assign_result
+  until: assign_result.finished
+  retries: 480
+  delay: 30
 '''
 
 RETURN = r'''
@@ -64,19 +210,161 @@ original_message:
             "not_assigned": [
                 "fail.com"
             ],
+            "ambiguous": {
+                "web01": ["web01.corp.local", "web01.dmz.local"]
+            },
+            "conflicts": {
+                "db01.corp.local": ["env: prod / staging"]
+            },
+            "timing": {
+                "elapsed_seconds": 42.7,
+                "rows_processed": 2000,
+                "writes_sent": 1850,
+                "phases": {
+                    "fetch": {"seconds": 12.4, "done": 0, "per_second": 0.0},
+                    "resolve": {"seconds": 0.9, "done": 2000, "per_second": 2222.22},
+                    "write": {"seconds": 29.4, "done": 1850, "per_second": 62.93}
+                }
+            }
         }
     }
+# The sample above is in full mode. In summary mode (the default), labels_assigned, not_assigned, ambiguous and
+# conflicts are each returned as {"count": 2000, "sample": ["success.com", ...]} and every item is in result_file
+result_file:
+    description:
+        - File holding every item, one JSON object per line (gzip-compressed)
+        - e.g. {"result": "labels_assigned", "item": "success.com"}, tagged with pce and org_href when targets is given
+    type: str
+    returned: in summary mode
+    sample: "/tmp/respiro_illumio_assign_labels_20211004T101500_4242.jsonl.gz"
+digest:
+    description: sha256 of the uncompressed content of result_file, equal for runs with the same outcomes
+    type: str
+    returned: in summary mode
+    sample: "9f2c6a1e0b7d4c3a8e5f1d2b6c9a0e4f7b3d8c1a5e2f6b9d0c4a7e1f3b8d2c6a"
+concurrency:
+    description: State of the adaptive concurrency limit at the end of the run
+    type: dict
+    returned: when concurrency is adaptive
+    sample: {"limit": 12, "min_limit": 4, "max_limit": 14, "decreases": 2, "p95_ms": 180.4}
+targets:
+    description: Per-target results, only returned when targets is given
+    type: list
+    returned: when targets is given
+    sample: [
+        {
+            "changed": true,
+            "pce": "poc1.illum.io",
+            "org_href": "/orgs/85",
+            "labels_assigned": ["success.com"],
+            "not_assigned": ["fail.com"],
+            "ambiguous": {},
+            "conflicts": {}
+        }
+    ]
 '''
 
-from ansible.module_utils.basic import AnsibleModule
-import time
+from ansible.module_utils.basic import AnsibleModule, missing_required_lib
+from collections import OrderedDict
 import csv
-import json
 
 # Import helper modules
-from ansible_collections.respiro.illumio.plugins.module_utils.credential import Credential
-from ansible_collections.respiro.illumio.plugins.module_utils.labels import create_label, create_label_href_dict
-from ansible_collections.respiro.illumio.plugins.module_utils.workloads import get_workloads, update_workload
+from ansible_collections.respiro.illumio.plugins.module_utils.api_calls import TRANSPORTS, HAS_HTTP2
+from ansible_collections.respiro.illumio.plugins.module_utils.credential import TARGET_OPTIONS, credentials_from_params
+from ansible_collections.respiro.illumio.plugins.module_utils.concurrency import fan_out, exit_fan_out, prefetch, \
+    run_concurrently, workers_for, with_concurrency
+from ansible_collections.respiro.illumio.plugins.module_utils.labels import MERGE_RULES, create_label_href_dict, \
+    label_href_dict, sync_labels, resolve_labels, label_hrefs, merge_label_rows
+from ansible_collections.respiro.illumio.plugins.module_utils.workloads import LABEL_FIELDS, fetch_workloads, \
+    sync_workloads, update_workload
+from ansible_collections.respiro.illumio.plugins.module_utils.matching import IpIndex, HostnameIndex
+from ansible_collections.respiro.illumio.plugins.module_utils.progress import ProgressFile
+from ansible_collections.respiro.illumio.plugins.module_utils.results import RESULT_MODES, SAMPLE_SIZE, \
+    prepare_result_file, summarise_results
+from ansible_collections.respiro.illumio.plugins.module_utils.profiling import run_profiled
+
+# Per-item outcomes of a run, summarised in summary mode
+OUTCOMES = ('labels_assigned', 'not_assigned', 'ambiguous', 'conflicts')
+
+
+# Checks csv rows and compares labels in pce and labels in csv file, and assign labels to workloads
+# Rows are matched with workloads by "match": hostname, ip or cidr
+# Rows for the same workload are merged following "merge" so every workload is written at most once
+# Progress is reported to "progress" (a ProgressFile) if given
+# Runs against a single PCE and returns the result for that PCE
+def assign_workload_labels(cred, csv_rows, snapshot_dir=None, match='hostname', domain_suffixes=None,
+                           partition=None, merge='last_wins', progress=None):
+    outcome = {'assigned': [], 'not_assigned': [], 'ambiguous': dict(), 'conflicts': dict()}
+    tracker = (progress or ProgressFile()).tracker(cred)
+    tracker.set_rows(len(csv_rows))
+
+    # Get labels and workloads from the PCE, only keeping the fields needed to assign labels
+    # (and the interface addresses when matching by IP)
+    # Use the local snapshots if there are any, so only the changes since the last run are fetched
+    fields = LABEL_FIELDS if match == 'hostname' else LABEL_FIELDS + ('interfaces',)
+    # Both are fetched at the same time
+    tracker.phase("fetch")
+    if snapshot_dir:
+        inventory = prefetch(cred,
+                             labels=lambda cred: label_href_dict(sync_labels(cred, snapshot_dir)),
+                             workloads=lambda cred: sync_workloads(cred, snapshot_dir, fields))
+    else:
+        inventory = prefetch(cred,
+                             labels=create_label_href_dict,
+                             workloads=lambda cred: fetch_workloads(cred, fields, partitions=partition))
+    labels_details = inventory['labels']
+    workloads_list = inventory['workloads']
+    if match != 'hostname':
+        index = IpIndex(workloads_list)
+    else:
+        index = HostnameIndex(workloads_list, domain_suffixes)
+
+    # Resolve all labels of the csv file at once, creating the missing ones
+    tracker.phase("resolve", len(csv_rows))
+    labels_table = resolve_labels(cred, csv_rows, labels_details)
+
+    # Find the workloads of every row and collect all the rows of each workload
+    workload_rows = OrderedDict()
+    for rows in csv_rows:
+        row_key = rows[match]
+        tracker.advance(rows=1)
+
+        # Workloads within the IP/subnet of the row
+        if match != 'hostname':
+            matches = index.lookup(row_key)
+        # check the workload from PCE with workload from csv file
+        # A normalised hostname matching several workloads is reported instead of assigned
+        else:
+            matches, ambiguous = index.lookup(row_key)
+            if ambiguous:
+                outcome['ambiguous'][row_key] = [workload.hostname for workload in matches]
+                continue
+
+        for workload in matches:
+            workload_rows.setdefault(workload.href, (workload, []))[1].append(rows)
+            outcome['assigned'].append(row_key)
+        if not matches:
+            outcome['not_assigned'].append(row_key)
+
+    # Merge the rows of each workload into its final labels
+    # and only update the workloads whose labels differ, one request per workload
+    updates = []
+    for workload, rows_list in workload_rows.values():
+        merged, conflicts = merge_label_rows(rows_list, merge)
+        if conflicts:
+            outcome['conflicts'][workload.hostname or workload.href] = conflicts
+        hrefs = label_hrefs(labels_table, merged)
+        if set(hrefs) != set(workload.labels):
+            updates.append((workload.href, [{"href": href} for href in hrefs]))
+
+    def write(update):
+        update_workload(cred, update[0], {'labels': update[1]})
+        tracker.advance(writes=1)
+
+    tracker.phase("write", len(updates), "writes")
+    run_concurrently(write, updates, workers_for(cred))
+    return dict(changed=len(updates) > 0, labels_assigned=outcome['assigned'], not_assigned=outcome['not_assigned'],
+                ambiguous=outcome['ambiguous'], conflicts=outcome['conflicts'], timing=tracker.finish())
 
 
 def run_module():
@@ -84,109 +372,91 @@ def run_module():
         workload=dict(type='str', required=True),
         username=dict(type='str', required=True),
         auth_secret=dict(type='str', required=True),
-        pce=dict(type='str', required=True),
-        org_id=dict(type='str', required=True),
+        pce=dict(type='str', required=False),
+        org_id=dict(type='str', required=False),
+        targets=dict(type='list', elements='dict', required=False, options=TARGET_OPTIONS),
+        rate_limit=dict(type='float', required=False),
+        transport=dict(type='str', required=False, default='http1', choices=list(TRANSPORTS)),
+        concurrency=dict(type='str', required=False, default='fixed', choices=['fixed', 'adaptive']),
+        snapshot_dir=dict(type='str', required=False),
+        match=dict(type='str', required=False, default='hostname', choices=['hostname', 'ip', 'cidr']),
+        domain_suffixes=dict(type='list', elements='str', required=False),
+        partition=dict(type='str', required=False, choices=['managed']),
+        merge=dict(type='str', required=False, default='last_wins', choices=list(MERGE_RULES)),
+        progress_file=dict(type='str', required=False),
+        result_mode=dict(type='str', required=False, default='summary', choices=list(RESULT_MODES)),
+        result_file=dict(type='str', required=False),
+        sample_size=dict(type='int', required=False, default=SAMPLE_SIZE),
     )
     result = dict()
     module = AnsibleModule(
         argument_spec=module_args,
+        required_one_of=[('pce', 'targets')],
+        required_together=[('pce', 'org_id')],
+        mutually_exclusive=[('pce', 'targets')],
         supports_check_mode=True
     )
+    if module.params['transport'] == 'http2' and not HAS_HTTP2:
+        module.fail_json(msg=missing_required_lib('httpx[http2]'))
     workload = module.params['workload']
-    username = module.params["username"]
-    auth_secret = module.params["auth_secret"]
-    org_href = "/orgs/" + module.params["org_id"]
-    pce = module.params["pce"]
-    list = {'assigned': [], 'not_assigned': []}
+    snapshot_dir = module.params['snapshot_dir']
+    match = module.params['match']
+    domain_suffixes = module.params['domain_suffixes']
+    partition = module.params['partition']
+    merge = module.params['merge']
+    # Progress of every target, written to progress_file (if given) while the module runs
+    progress = ProgressFile(module.params['progress_file'])
 
-    # Initialize new credential
-    cred = Credential(username, auth_secret, pce, org_href)
+    # Initialize new credentials, one per PCE/org
+    creds = credentials_from_params(module.params)
 
     if module.check_mode:
         module.exit_json(**result)
 
-    # Main code: Checks csv file and compares labels in pce and labels in csv file, and assign labels to worloads
-    labels_details = create_label_href_dict(cred)
-    # getting data from the csv file and do the required operations
+    # Fail before making any change if the result file can't be written
+    if module.params['result_mode'] == 'summary':
+        try:
+            prepare_result_file(module.params['result_file'])
+        except (IOError, OSError) as e:
+            module.fail_json(msg="Unable to write result_file: {}".format(e))
+
+    # getting data from the csv file
     with open(workload, 'r') as details:
-        workload_details = csv.DictReader(details, delimiter=",")
-        for rows in workload_details:
-            hostname = rows["hostname"]
-            role = rows['role']
-            app = rows['app']
-            env = rows['env']
-            loc = rows['loc']
-
-            # Get workloads from the PCE
-            response = get_workloads(cred)
-            workloads_list = json.loads(response.text)
-
-            # Check if label already exists in PCE. If not add to PCE and get its href.
-            if role != "":
-                if role in labels_details['role']:
-                    role_href = labels_details['role'][role]
-                else:
-                    href = json.loads(create_label(cred, "role", role).content)['href']
-                    labels_details['role'][role] = href
-                    role_href = href
-            else:
-                role_href = ""
-            if app != "":
-                if app in labels_details['app']:
-                    app_href = labels_details['app'][app]
-                else:
-                    href = json.loads(create_label(cred, "app", app).content)['href']
-                    labels_details['app'][app] = href
-                    app_href = href
-            else:
-                app_href = ""
-            if env != "":
-                if env in labels_details['env']:
-                    env_href = labels_details['env'][env]
-                else:
-                    href = json.loads(create_label(cred, "env", env).content)['href']
-                    labels_details['env'][env] = href
-                    env_href = href
-            else:
-                env_href = ""
-            if loc != "":
-                if loc in labels_details['loc']:
-                    loc_href = labels_details['loc'][loc]
-                else:
-                    href = json.loads(create_label(cred, "loc", loc).content)['href']
-                    labels_details['loc'][loc] = href
-                    loc_href = href
-            else:
-                loc_href = ""
-
-            # Wait for the PCE to finish creating the new labels
-            # This is just a fail-safe
-            # Might not be necessary
-            time.sleep(4.0)
-
-            # check the workload from PCE with workload from csv file and assign labels
-            check = 0
-            for workload in workloads_list:
-                if workload['hostname'] == hostname:
-                    check = 1
-                    label = []
-                    if role_href:
-                        label.append({"href": role_href})
-                    if app_href:
-                        label.append({"href": app_href})
-                    if env_href:
-                        label.append({"href": env_href})
-                    if loc_href:
-                        label.append({"href": loc_href})
-                    update_workload(cred, workload['href'], {'labels': label})
-                    list['assigned'].append(hostname)
-            if check == 0:
-                list['not_assigned'].append(hostname)
-        module.exit_json(changed=True, labels_assigned=list['assigned'], not_assigned=list['not_assigned'])
+        csv_rows = list(csv.DictReader(details, delimiter=","))
+
+    # Run against every target at once
+    if module.params['targets']:
+        results = fan_out(creds, assign_workload_labels, csv_rows, snapshot_dir, match, domain_suffixes, partition,
+                          merge, progress)
+    else:
+        # Errors are reported like fan_out reports them for a target
+        try:
+            results = [with_concurrency(creds[0], assign_workload_labels(creds[0], csv_rows, snapshot_dir, match,
+                                                                         domain_suffixes, partition, merge,
+                                                                         progress))]
+        except Exception as e:
+            module.fail_json(msg=str(e))
+
+    # Keep the result small: counts and samples, the items go to the result file
+    summary = dict()
+    if module.params['result_mode'] == 'summary':
+        try:
+            summary = summarise_results(results, OUTCOMES, module.params['result_file'], "assign_labels",
+                                        module.params['sample_size'])
+        except (IOError, OSError) as e:
+            # The changes are made already, return them in full rather than losing them
+            msg = "Unable to write result_file: {}".format(e)
+            changed = any(result.get('changed') for result in results)
+            if module.params['targets']:
+                module.fail_json(msg=msg, changed=changed, targets=results)
+            module.fail_json(**dict(results[0], msg=msg, changed=changed))
+    if module.params['targets']:
+        exit_fan_out(module, results, **summary)
+    module.exit_json(**dict(results[0], **summary))
 
 
 def main():
-    run_module()
+    run_profiled(run_module, "assign_labels")
 
 
 if __name__ == '__main__':
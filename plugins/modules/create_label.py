@@ -35,13 +35,36 @@ options:
         required: true
         type: str
     pce:
-        description: This takes the url link to Illumio PCE
-        required: true
+        description: This takes the url link to Illumio PCE. Required unless targets is given
+        required: false
         type: str
     org-id:
-        description: This takes the organisation ID for Illumio PCE
-        required: true
+        description: This takes the organisation ID for Illumio PCE. Required unless targets is given
+        required: false
+        type: str
+    targets:
+        description:
+            - List of PCE/org targets to add the labels to at the same time, instead of pce and org_id
+            - Each target takes pce, org_id and optionally port, username and auth_secret
+            - username, auth_secret default to the top-level values, port defaults to 443
+        required: false
+        type: list
+        elements: dict
+    rate_limit:
+        description: Maximum number of requests per second sent to each PCE
+        required: false
+        type: float
+    transport:
+        description:
+            - HTTP transport used to reach the PCE
+            - http1 opens one connection per request in flight
+            - http2 multiplexes the requests in flight over a single connection, which helps with proxies limiting
+              the number of connections; requires the httpx and h2 Python packages
+            - stdlib only uses the Python standard library (no requests import), the quickest to start for small runs
+        required: false
         type: str
+        choices: ['http1', 'http2', 'stdlib']
+        default: http1
 
 author:
     - Safal Khanal (@safalkhanal)
@@ -68,6 +91,18 @@ EXAMPLES = r'''
     name: "test_application"
     type: "app"
 
+# Add the same label catalogue to several PCEs at once
+- name: Test with several PCEs
+  respiro.illumio.create_label:
+    username: "testuser"
+    auth_secret: "testpass"
+    targets:
+      - pce: "pce1_url"
+        org_id: "80"
+      - pce: "pce2_url"
+        org_id: "3"
+    path: "labels.csv"
+
 # fail the module
 - name: Test failure of the module
   respiro.illumio.create_label:
@@ -82,11 +117,12 @@ EXAMPLES = r'''
 RETURN = r'''
 # These are examples of possible return values, and in general should use other names for return values.
 error:
-    description: List of label that module was not able to add to PCE.
+    description: List of label that module was not able to add to PCE, with the HTTP status when the PCE refused it (406 if it already exists).
     type: list
     returned: always
     sample:  [
-            "Invalid type:ap. Type should be either env,app,loc,role"
+            "Invalid type:ap. Type should be either env,app,loc,role",
+            "app : crm (HTTP 406)"
         ],
 
 success:
@@ -96,15 +132,42 @@ success:
     sample:  [
             "app : new_app3"
         ],
+
+targets:
+    description: Per-target error and success lists, tagged with pce and org_href.
+    type: list
+    returned: when targets is given
+    sample:  [
+            {"pce": "pce1_url", "org_href": "/orgs/80", "changed": true, "error": [], "success": ["app : new_app3"]}
+        ],
 '''
 
 
-from ansible.module_utils.basic import AnsibleModule
-import csv
+from ansible.module_utils.basic import AnsibleModule, missing_required_lib
 
 # Import helper modules
-from ansible_collections.respiro.illumio.plugins.module_utils.credential import Credential
-from ansible_collections.respiro.illumio.plugins.module_utils.labels import create_label
+from ansible_collections.respiro.illumio.plugins.module_utils.api_calls import TRANSPORTS, HAS_HTTP2
+from ansible_collections.respiro.illumio.plugins.module_utils.credential import TARGET_OPTIONS, credentials_from_params
+from ansible_collections.respiro.illumio.plugins.module_utils.labels import LABEL_TYPES, create_label
+from ansible_collections.respiro.illumio.plugins.module_utils.concurrency import fan_out, exit_fan_out
+from ansible_collections.respiro.illumio.plugins.module_utils.profiling import run_profiled
+
+
+# Add the (type, name) pairs to a single PCE
+# Returns the labels that were added, and the ones with an invalid type or refused by the PCE
+# (e.g. HTTP 406 for a label that already exists)
+def add_labels(cred, new_labels):
+    list = {"success": [], "error": []}
+    for key, value in new_labels:
+        if key in LABEL_TYPES:
+            response = create_label(cred, key, value)
+            if response.status_code == 201:
+                list["success"].append(key + " : " + value)
+            else:
+                list["error"].append(key + " : " + value + " (HTTP {})".format(response.status_code))
+        else:
+            list["error"].append("Invalid type:" + key + ". Type should be either env,app,loc,role")
+    return dict(changed=len(list["success"]) > 0, error=list["error"], success=list["success"])
 
 
 def run_module():
@@ -115,56 +178,59 @@ def run_module():
         path=dict(type='str', required=False),
         username=dict(type='str', required=True),
         auth_secret=dict(type='str', required=True),
-        pce=dict(type='str', required=True),
-        org_id=dict(type='str', required=True),
+        pce=dict(type='str', required=False),
+        org_id=dict(type='str', required=False),
+        targets=dict(type='list', elements='dict', required=False, options=TARGET_OPTIONS),
+        rate_limit=dict(type='float', required=False),
+        transport=dict(type='str', required=False, default='http1', choices=list(TRANSPORTS)),
     )
     result = dict()
     module = AnsibleModule(
         argument_spec=module_args,
+        required_one_of=[('pce', 'targets')],
+        required_together=[('pce', 'org_id')],
+        mutually_exclusive=[('pce', 'targets')],
         supports_check_mode=True
     )
+    if module.params['transport'] == 'http2' and not HAS_HTTP2:
+        module.fail_json(msg=missing_required_lib('httpx[http2]'))
     l_name = module.params['name']
     l_type = module.params['type']
     l_path = module.params['path']
-    login = module.params["username"]
-    auth_secret = module.params["auth_secret"]
-    org_href = "/orgs/" + module.params["org_id"]
-    pce = module.params["pce"]
 
-    # Initialize new credential
-    cred = Credential(login, auth_secret, pce, org_href)
+    # Initialize new credentials, one per PCE/org
+    creds = credentials_from_params(module.params)
 
     if module.check_mode:
         module.exit_json(**result)
-    list = {"success": [], "error": []}
     try:
         if l_path:
+            # Only needed for files, a single label doesn't pay for the import
+            import csv
             with open(l_path, 'r') as data_file:
                 label_value = csv.DictReader(data_file, delimiter=",")
-                for rows in label_value:
-                    key = rows["type"]
-                    value = rows["name"]
-                    if key == 'loc' or key == 'env' or key == 'role' or key == 'app':
-                        response = create_label(cred, key, value)
-                        list["success"].append(key + " : " + value)
-                    else:
-                        list["error"].append("Invalid type:" + key + ". Type should be either env,app,loc,role")
+                new_labels = [(rows["type"], rows["name"]) for rows in label_value]
         elif l_type and l_name:
-            if l_type == 'env' or l_type == 'loc' or l_type == 'app' or l_type == 'role':
-                y = {"key": l_type, "value": l_name}
-                list["success"].append(l_type + " : " + l_name)
-                response = create_label(cred, l_type, l_name)
-            else:
+            if l_type not in LABEL_TYPES:
                 module.exit_json(msg="Invalid type value.", failed=l_type)
+            new_labels = [(l_type, l_name)]
         else:
             module.exit_json(msg="Parameter mismatch.")
-        module.exit_json(error=list["error"], success=list["success"])
+
+        # Add the labels to every target at once
+        if module.params['targets']:
+            results = fan_out(creds, add_labels, new_labels)
+        else:
+            results = [add_labels(creds[0], new_labels)]
     except Exception as e:
         module.fail_json(msg="Error!!")
+    if module.params['targets']:
+        exit_fan_out(module, results)
+    module.exit_json(**results[0])
 
 
 def main():
-    run_module()
+    run_profiled(run_module, "create_label")
 
 
 if __name__ == '__main__':
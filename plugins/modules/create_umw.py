@@ -11,7 +11,8 @@ short_description: This is the module to create unmanaged workloads in PCE
 version_added: "1.0.8"
 
 description: Use this module to add unmanaged workloads to PCE. pass the path to csv file containing workload information and assiciated label along with credentials to
-PCE to add unmanaged workloads to PCE
+PCE to add unmanaged workloads to PCE. In upsert mode, existing unmanaged workloads are matched by hostname (then IP)
+and only the missing or different ones are written, so the module can be re-run safely.
 
 options:
     username:
@@ -23,17 +24,67 @@ options:
         required: true
         type: str
     pce:
-        description: This takes the url link to Illumio PCE
-        required: true
+        description: This takes the url link to Illumio PCE. Required unless targets is given
+        required: false
         type: str
     org_id:
-        description: This takes the organisation ID for Illumio PCE
-        required: true
+        description: This takes the organisation ID for Illumio PCE. Required unless targets is given
+        required: false
+        type: str
+    targets:
+        description:
+            - List of PCE/org targets to add the workloads to at the same time, instead of pce and org_id
+            - Each target takes pce, org_id and optionally port, username and auth_secret
+            - username, auth_secret default to the top-level values, port defaults to 443
+        required: false
+        type: list
+        elements: dict
+    rate_limit:
+        description: Maximum number of requests per second sent to each PCE
+        required: false
+        type: float
+    transport:
+        description:
+            - HTTP transport used to reach the PCE
+            - http1 opens one connection per request in flight
+            - http2 multiplexes the requests in flight over a single connection, which helps with proxies limiting
+              the number of connections; requires the httpx and h2 Python packages
+            - stdlib only uses the Python standard library (no requests import), the quickest to start for small runs
+        required: false
         type: str
+        choices: ['http1', 'http2', 'stdlib']
+        default: http1
+    concurrency:
+        description:
+            - fixed sends a fixed number of requests at the same time
+            - adaptive starts low and raises the number of requests in flight while the PCE's p95 latency stays
+              healthy, and halves it on HTTP 429/503, timeouts, connection errors or rising latency (AIMD)
+            - With adaptive, the limit reached is returned under concurrency
+        required: false
+        type: str
+        choices: ['fixed', 'adaptive']
+        default: fixed
     workload:
         description: This takes the path to csv file containing workload information
         required: true
         type: str
+    mode:
+        description:
+            - create adds every row of the csv file as a new unmanaged workload
+            - upsert exports the existing unmanaged workloads once, creates only the missing ones and updates
+              only the ones whose labels, IP or hostname differ, using the PCE's bulk requests
+            - upsert supports check mode
+        required: false
+        type: str
+        choices: ['create', 'upsert']
+        default: create
+    progress_file:
+        description:
+            - Path of a JSON file updated while the module runs, for long runs started with Ansible async
+            - Holds, per PCE/org, the current phase (fetch, resolve, write), rows processed, writes sent,
+              throughput and estimated time left of the phase
+        required: false
+        type: str
 
 author:
     - Safal Khanal (@Safalkhanal)
@@ -49,6 +100,50 @@ EXAMPLES = r'''
     pce: "poc1.illum.io"
     org_id: "80"
     workload: "workload.csv"
+
+# Re-run safely: only create/update what differs from the PCE
+- name: Test with upsert mode
+  respiro.illumio.create_umw:
+    username: "api_12321323cf4545"
+    auth_secret: "097jhdjksb9387384hjd3384bnfj93"
+    pce: "poc1.illum.io"
+    org_id: "80"
+    workload: "workload.csv"
+    mode: upsert
+
+# Add the same workloads to several PCEs at once
+- name: Test with several PCEs
+  respiro.illumio.create_umw:
+    username: "api_12321323cf4545"
+    auth_secret: "097jhdjksb9387384hjd3384bnfj93"
+    targets:
+      - pce: "poc1.illum.io"
+        org_id: "80"
+      - pce: "poc2.illum.io"
+        org_id: "7"
+    workload: "workload.csv"
+
+# Long run in the background: progress is in the progress file, the result is polled with async_status
+- name: Test with async and a progress file
+  respiro.illumio.create_umw:
+    username: "api_12321323cf4545"
+    auth_secret: "097jhdjksb9387384hjd3384bnfj93"
+    pce: "poc1.illum.io"
+    org_id: "80"
+    workload: "workload.csv"
+    mode: upsert
+    progress_file: "/tmp/create_umw_progress.json"
+  async: 14400
+  poll: 0
+  register: umw_job
+
+- name: Wait for the workloads
+  ansible.builtin.async_status:
+    jid: "{{ umw_job.ansible_job_id }}"
+  register: umw_result
+  until: umw_result.finished
+  retries: 480
+  delay: 30
 '''
 
 RETURN = r'''
@@ -64,17 +159,111 @@ sample:
         "meta": "Workload added",
      }
     }
+# In upsert mode, the result lists the hostnames that were "created", "updated" and "unchanged",
+# and the per-workload "errors" reported by the PCE
+# With concurrency: adaptive, "concurrency" gives the limit of requests in flight reached (limit, min_limit,
+# max_limit, decreases, p95_ms)
+# "timing" gives the duration and throughput of every phase of the run (fetch, resolve, write)
+# When targets is given, "targets" holds one such result per PCE/org, tagged with pce and org_href
 '''
 
-from ansible.module_utils.basic import AnsibleModule
-import time
-import json
+from ansible.module_utils.basic import AnsibleModule, missing_required_lib
 import csv
 
 # Import helper modules
-from ansible_collections.respiro.illumio.plugins.module_utils.credential import Credential
-from ansible_collections.respiro.illumio.plugins.module_utils.labels import create_label, create_label_href_dict
-from ansible_collections.respiro.illumio.plugins.module_utils.workloads import create_umw
+from ansible_collections.respiro.illumio.plugins.module_utils.api_calls import TRANSPORTS, HAS_HTTP2
+from ansible_collections.respiro.illumio.plugins.module_utils.credential import TARGET_OPTIONS, credentials_from_params
+from ansible_collections.respiro.illumio.plugins.module_utils.concurrency import fan_out, exit_fan_out, prefetch, \
+    with_concurrency
+from ansible_collections.respiro.illumio.plugins.module_utils.labels import create_label_href_dict, resolve_labels, \
+    label_hrefs
+from ansible_collections.respiro.illumio.plugins.module_utils.workloads import UMW_FIELDS, create_umw, fetch_workloads, \
+    umw_payload, bulk_create_workloads, bulk_update_workloads
+from ansible_collections.respiro.illumio.plugins.module_utils.progress import ProgressFile
+from ansible_collections.respiro.illumio.plugins.module_utils.profiling import run_profiled
+
+
+# Add the workloads from the csv rows (and their labels) to a single PCE
+# Progress is reported to "progress" (a ProgressFile) if given
+# Returns the result for that PCE
+def add_workloads(cred, csv_rows, progress=None):
+    tracker = (progress or ProgressFile()).tracker(cred)
+    tracker.set_rows(len(csv_rows))
+    # Resolve all labels of the csv file at once, creating the missing ones
+    tracker.phase("resolve")
+    labels_table = resolve_labels(cred, csv_rows)
+    tracker.phase("write", len(csv_rows), "writes")
+    for rows in csv_rows:
+        create_umw(cred, rows["name"], rows["hostname"], rows["ip"], *label_hrefs(labels_table, rows))
+        tracker.advance(rows=1, writes=1)
+    return dict(changed=True, meta='Workload added', timing=tracker.finish())
+
+
+# Make the unmanaged workloads of a single PCE match the csv rows
+# The existing unmanaged workloads are exported once and indexed by hostname and interface IP
+# Rows without a matching workload are created, matching workloads with different labels,
+# IP or hostname are updated, everything else is left alone; writes are sent in bulk
+# Progress is reported to "progress" (a ProgressFile) if given
+# Returns the result for that PCE
+def upsert_workloads(cred, csv_rows, check_mode=False, progress=None):
+    tracker = (progress or ProgressFile()).tracker(cred)
+    tracker.set_rows(len(csv_rows))
+    # Labels and unmanaged workloads are fetched at the same time
+    tracker.phase("fetch")
+    inventory = prefetch(cred,
+                         labels=create_label_href_dict,
+                         workloads=lambda cred: fetch_workloads(cred, UMW_FIELDS, {"managed": "false"}))
+    tracker.phase("resolve", len(csv_rows))
+    labels_table = resolve_labels(cred, csv_rows, inventory['labels'], create_missing=not check_mode)
+    by_hostname = dict()
+    by_ip = dict()
+    for workload in inventory['workloads']:
+        if workload.hostname:
+            by_hostname.setdefault(workload.hostname, workload)
+        for address in workload.interfaces:
+            by_ip.setdefault(address, workload)
+
+    # When several rows are for the same workload, the last one wins
+    to_create = dict()
+    to_update = dict()
+    updated_hostnames = dict()
+    unchanged = []
+    for rows in csv_rows:
+        hostname = rows["hostname"]
+        ip = rows["ip"]
+        hrefs = label_hrefs(labels_table, rows)
+        workload = by_hostname.get(hostname) or by_ip.get(ip)
+        tracker.advance(rows=1)
+        if workload is None:
+            to_create[hostname] = umw_payload(rows["name"], hostname, ip, hrefs)
+            continue
+        changes = dict()
+        if set(hrefs) != set(workload.labels):
+            changes["labels"] = [{"href": href} for href in hrefs]
+        if ip not in workload.interfaces:
+            payload = umw_payload(rows["name"], hostname, ip, hrefs)
+            changes["public_ip"] = payload["public_ip"]
+            changes["interfaces"] = payload["interfaces"]
+        if workload.hostname != hostname:
+            changes["hostname"] = hostname
+        if changes:
+            changes["href"] = workload.href
+            to_update[workload.href] = changes
+            updated_hostnames[workload.href] = hostname
+        else:
+            unchanged.append(hostname)
+
+    errors = []
+    if not check_mode:
+        tracker.phase("write", len(to_create) + len(to_update), "writes")
+        results = bulk_create_workloads(cred, list(to_create.values()),
+                                        on_batch=lambda count: tracker.advance(writes=count))
+        results += bulk_update_workloads(cred, list(to_update.values()),
+                                         on_batch=lambda count: tracker.advance(writes=count))
+        errors = [result for result in results if result.get('errors')]
+    return dict(changed=bool(to_create or to_update), created=list(to_create.keys()),
+                updated=list(updated_hostnames.values()), unchanged=unchanged, errors=errors,
+                timing=tracker.finish())
 
 
 def run_module():
@@ -82,80 +271,53 @@ def run_module():
         workload=dict(type='str', required=True),
         username=dict(type='str', required=True),
         auth_secret=dict(type='str', required=True),
-        pce=dict(type='str', required=True),
-        org_id=dict(type='str', required=True),
+        pce=dict(type='str', required=False),
+        org_id=dict(type='str', required=False),
+        targets=dict(type='list', elements='dict', required=False, options=TARGET_OPTIONS),
+        rate_limit=dict(type='float', required=False),
+        transport=dict(type='str', required=False, default='http1', choices=list(TRANSPORTS)),
+        concurrency=dict(type='str', required=False, default='fixed', choices=['fixed', 'adaptive']),
+        mode=dict(type='str', required=False, default='create', choices=['create', 'upsert']),
+        progress_file=dict(type='str', required=False),
     )
     result = dict()
     module = AnsibleModule(
         argument_spec=module_args,
+        required_one_of=[('pce', 'targets')],
+        required_together=[('pce', 'org_id')],
+        mutually_exclusive=[('pce', 'targets')],
         supports_check_mode=True
     )
+    if module.params['transport'] == 'http2' and not HAS_HTTP2:
+        module.fail_json(msg=missing_required_lib('httpx[http2]'))
     workload = module.params['workload']
-    login = module.params["username"]
-    auth_secret = module.params["auth_secret"]
-    org_href = "/orgs/" + module.params["org_id"]
-    pce = module.params["pce"]
 
-    cred = Credential(login, auth_secret, pce, org_href)
-    labels_details = create_label_href_dict(cred)
+    # Initialize new credentials, one per PCE/org
+    creds = credentials_from_params(module.params)
+
     with open(workload, 'r') as details:
-        workload_details = csv.DictReader(details, delimiter=",")
-        for rows in workload_details:
-            name = rows["name"]
-            hostname = rows["hostname"]
-            ip = rows["ip"]
-            role = rows["role"]
-            app = rows["app"]
-            env = rows["env"]
-            loc = rows["loc"]
-            if role is not "":
-                if role in labels_details['role']:
-                    role = labels_details['role'][role]
-                else:
-                    href = json.loads(create_label(cred, "role", role).content)['href']
-                    labels_details['role'][role] = href
-                    role = href
-            else:
-                role = ""
-            if app is not "":
-                if app in labels_details['app']:
-                    app = labels_details['app'][app]
-                else:
-                    href = json.loads(create_label(cred, "app", app).content)['href']
-                    labels_details['app'][app] = href
-                    app = href
-            else:
-                app = ""
-            if env is not "":
-                if env in labels_details['env']:
-                    env = labels_details['env'][env]
-                else:
-                    href = json.loads(create_label(cred, "env", env).content)['href']
-                    labels_details['env'][env] = href
-                    env = href
-            else:
-                env = ""
-            if loc is not "":
-                if loc in labels_details['loc']:
-                    loc = labels_details['loc'][loc]
-                else:
-                    href = json.loads(create_label(cred, "loc", loc).content)['href']
-                    labels_details['loc'][loc] = href
-                    loc = href
-            else:
-                loc = ""
-
-            # Wait for the PCE to finish creating the new labels
-            # This is just a fail-safe
-            # Might not be necessary
-            time.sleep(4.0)
-
-            create_umw(cred, name, hostname, ip, role, app, env, loc)
-    module.exit_json(changed=True, meta='Workload added')
+        csv_rows = list(csv.DictReader(details, delimiter=","))
+
+    # Progress of every target, written to progress_file (if given) while the module runs
+    progress = ProgressFile(module.params['progress_file'])
+    if module.params['mode'] == 'upsert':
+        operation, args = upsert_workloads, (csv_rows, module.check_mode, progress)
+    else:
+        operation, args = add_workloads, (csv_rows, progress)
+
+    # Add the workloads to every target at once
+    if module.params['targets']:
+        exit_fan_out(module, fan_out(creds, operation, *args))
+    # Errors are reported like fan_out reports them for a target
+    try:
+        result = with_concurrency(creds[0], operation(creds[0], *args))
+    except Exception as e:
+        module.fail_json(msg=str(e))
+    module.exit_json(**result)
 
 
 def main():
-    run_module()
+    run_profiled(run_module, "create_umw")
 
 
 if __name__ == '__main__':
@@ -24,18 +24,56 @@ options:
         required: true
         type: str
     pce:
-        description: This takes the url link to Illumio PCE
-        required: true
+        description: This takes the url link to Illumio PCE. Required unless targets is given
+        required: false
         type: str
     org-id:
-        description: This takes the organisation ID for Illumio PCE
-        required: true
+        description: This takes the organisation ID for Illumio PCE. Required unless targets is given
+        required: false
         type: str
+    targets:
+        description:
+            - List of PCE/org targets to get the labels of at the same time, instead of pce and org_id
+            - Each target takes pce, org_id and optionally port, username and auth_secret
+            - username, auth_secret default to the top-level values, port defaults to 443
+        required: false
+        type: list
+        elements: dict
     type:
         description:
             - type of label that you want to display ('all', 'env', 'loc', 'app', 'role').
         required: true
         type: str
+    transport:
+        description:
+            - HTTP transport used to reach the PCE
+            - http1 uses requests
+            - http2 uses httpx, requires the httpx and h2 Python packages
+            - stdlib only uses the Python standard library (no requests import), the quickest to start
+        required: false
+        type: str
+        choices: ['http1', 'http2', 'stdlib']
+        default: http1
+    result_mode:
+        description:
+            - summary returns the number of labels and a sample of sample_size labels, and writes every label to
+              result_file (gzip-compressed JSON lines) with a digest of its content
+            - full returns every label in the result
+        required: false
+        type: str
+        choices: ['summary', 'full']
+        default: summary
+    result_file:
+        description:
+            - Path of the file the labels are written to in summary mode, on the machine running the module
+            - Defaults to a new respiro_illumio_display_label_info_<time>_<pid>.jsonl.gz file in the temp directory
+        required: false
+        type: str
+    sample_size:
+        description: Number of labels kept in the sample in summary mode
+        required: false
+        type: int
+        default: 20
 
 author:
     - Safal Khanal (@safalkhanal99)
@@ -51,6 +89,17 @@ EXAMPLES = r'''
         auth_secret: "097jhdjksb9387384hjd3384bnfj93"
         pce: "poc1.illum.io"
         org_id: "80"
+
+    - name: display the environment labels of two PCEs
+      respiro.illumio.display_label_info:
+        type: "env"
+        username: "api_12321323cf4545"
+        auth_secret: "097jhdjksb9387384hjd3384bnfj93"
+        targets:
+          - pce: "poc1.illum.io"
+            org_id: "80"
+          - pce: "poc2.illum.io"
+            org_id: "3"
 '''
 
 RETURN = r'''
@@ -80,14 +129,35 @@ sample:
             },
         }
     }
+# The sample above is in full mode. In summary mode (the default), "success" is {"count": ..., "sample": [...]},
+# every label is in "result_file" (one {"result": "success", "item": <label>} object per line, gzip-compressed)
+# and "digest" is the sha256 of its uncompressed content
+# With targets, the result has one entry per target under "targets", each with its "success" and tagged with pce and
+# org_href (as are the lines of "result_file")
 '''
 
-from ansible.module_utils.basic import AnsibleModule
-import json
+from ansible.module_utils.basic import AnsibleModule, missing_required_lib
 
 # Import helper modules
-from ansible_collections.respiro.illumio.plugins.module_utils.credential import Credential
+from ansible_collections.respiro.illumio.plugins.module_utils.credential import TARGET_OPTIONS, credentials_from_params
 from ansible_collections.respiro.illumio.plugins.module_utils.labels import get_labels
+from ansible_collections.respiro.illumio.plugins.module_utils.api_calls import TRANSPORTS, HAS_HTTP2, decode
+from ansible_collections.respiro.illumio.plugins.module_utils.results import RESULT_MODES, SAMPLE_SIZE, \
+    prepare_result_file, summarise_results
+from ansible_collections.respiro.illumio.plugins.module_utils.concurrency import fan_out, exit_fan_out
+from ansible_collections.respiro.illumio.plugins.module_utils.profiling import run_profiled
+
+
+# Get the labels of a single PCE, all of them or only the ones of a type
+def list_labels(cred, input_type):
+    obj = decode(get_labels(cred))
+    labels_list = []
+    for values in obj:
+        if values['key'] == input_type:
+            labels_list.append(values)
+        elif input_type == 'all':
+            labels_list.append(values)
+    return dict(changed=True, success=labels_list)
 
 
 def run_module():
@@ -97,26 +167,40 @@ def run_module():
         type=dict(type='str', required=True),
         username=dict(type='str', required=True),
         auth_secret=dict(type='str', required=True),
-        pce=dict(type='str', required=True),
-        org_id=dict(type='str', required=True),
+        pce=dict(type='str', required=False),
+        org_id=dict(type='str', required=False),
+        targets=dict(type='list', elements='dict', required=False, options=TARGET_OPTIONS),
+        transport=dict(type='str', required=False, default='http1', choices=list(TRANSPORTS)),
+        result_mode=dict(type='str', required=False, default='summary', choices=list(RESULT_MODES)),
+        result_file=dict(type='str', required=False),
+        sample_size=dict(type='int', required=False, default=SAMPLE_SIZE),
     )
     result = dict()
     module = AnsibleModule(
         argument_spec=module_args,
+        required_one_of=[('pce', 'targets')],
+        required_together=[('pce', 'org_id')],
+        mutually_exclusive=[('pce', 'targets')],
         supports_check_mode=True
     )
+    if module.params['transport'] == 'http2' and not HAS_HTTP2:
+        module.fail_json(msg=missing_required_lib('httpx[http2]'))
 
-    username = module.params["username"]
-    auth_secret = module.params["auth_secret"]
-    pce = module.params["pce"]
-    org_href = "/orgs/" + module.params["org_id"]
     input_type = module.params["type"]
 
-    # Initialize new credential
-    cred = Credential(username, auth_secret, pce, org_href)
+    # Initialize new credentials, one per PCE/org
+    creds = credentials_from_params(module.params)
 
     if module.check_mode:
         module.exit_json(**result)
+
+    # Fail before querying the PCE if the result file can't be written
+    if module.params['result_mode'] == 'summary':
+        try:
+            prepare_result_file(module.params['result_file'])
+        except (IOError, OSError) as e:
+            module.fail_json(msg="Unable to write result_file: {}".format(e))
+
     checksum = 0
     for label_type in TYPE:
         if (input_type == label_type):
@@ -125,23 +209,35 @@ def run_module():
     if checksum == 0:
         module.fail_json(msg="Error!! Invalid label type.")
 
-    try:
-        response = get_labels(cred)
-        obj = json.loads(response.text)
-        list = []
-        for values in obj:
-            if values['key'] == input_type:
-                list.append(values)
-            elif input_type == 'all':
-                list.append(values)
-        module.exit_json(changed=True, success=list)
-
-    except Exception as e:
-        module.fail_json(msg="Error. Could not connect to PCE. This may be due to wrong credentials!!")
+    # Get the labels of every target at once
+    if module.params['targets']:
+        results = fan_out(creds, list_labels, input_type)
+    else:
+        try:
+            results = [list_labels(creds[0], input_type)]
+        except Exception as e:
+            module.fail_json(msg="Error. Could not connect to PCE. This may be due to wrong credentials!!")
+
+    # Keep the result small: the number of labels and a sample, the labels go to the result file
+    summary = dict()
+    if module.params['result_mode'] == 'summary':
+        try:
+            summary = summarise_results(results, ('success',), module.params['result_file'], "display_label_info",
+                                        module.params['sample_size'])
+        except (IOError, OSError) as e:
+            # Return the labels in full rather than losing them
+            msg = "Unable to write result_file: {}".format(e)
+            changed = any(result.get('changed') for result in results)
+            if module.params['targets']:
+                module.fail_json(msg=msg, changed=changed, targets=results)
+            module.fail_json(**dict(results[0], msg=msg, changed=changed))
+    if module.params['targets']:
+        exit_fan_out(module, results, **summary)
+    module.exit_json(**dict(results[0], **summary))
 
 
 def main():
-    run_module()
+    run_profiled(run_module, "display_label_info")
 
 
 if __name__ == '__main__':
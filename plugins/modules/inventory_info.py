@@ -0,0 +1,197 @@
+from __future__ import (absolute_import, division, print_function)
+
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+module: respiro.illumio.inventory_info
+
+short_description: This module answers questions about workloads from a local inventory store
+
+version_added: "1.1.5"
+
+description: This module keeps a local SQLite copy of the PCE's labels and workloads (with indexes on hostname, IP,
+label and href) and queries it. The store can be refreshed from the PCE or used as is, in which case queries take
+milliseconds instead of a full export. Filters are combined, only the workloads matching all of them are returned.
+
+options:
+    username:
+        description: This takes the user key value to access Illumio API
+        required: true
+        type: str
+    auth_secret:
+        description: This takes the API secret key to access Illumio API
+        required: true
+        type: str
+    pce:
+        description: This takes the url link to Illumio PCE
+        required: true
+        type: str
+    org_id:
+        description: This takes the organisation ID for Illumio PCE
+        required: true
+        type: str
+    port:
+        description: The port number, default to 443
+        required: false
+        type: str
+    db:
+        description: This takes the path to the SQLite inventory store
+        required: true
+        type: str
+    refresh:
+        description: Reload the store from the PCE before querying it
+        required: false
+        type: bool
+        default: true
+    snapshot_dir:
+        description: Directory of the local snapshots used to refresh the store with only the changes since the last run
+        required: false
+        type: str
+    hostname:
+        description: Only workloads with this hostname (case insensitive)
+        required: false
+        type: str
+    ip:
+        description: Only workloads with an interface address in this IP or subnet (CIDR notation)
+        required: false
+        type: str
+    label:
+        description: Only workloads with this label, given as type=name (e.g. env=prod)
+        required: false
+        type: str
+    missing_label:
+        description: Only workloads without a label of this type ('role', 'app', 'env', 'loc')
+        required: false
+        type: str
+
+author:
+    - Nghia Huu (David) Nguyen (@DAVPFSN)
+'''
+
+EXAMPLES = r'''
+- name: Production workloads without an application label
+  respiro.illumio.inventory_info:
+    username: "testusername"
+    auth_secret: "testpassword"
+    pce: "poc1.illum.io"
+    org_id: "85"
+    db: "/var/tmp/illumio_inventory.db"
+    label: "env=prod"
+    missing_label: "app"
+
+- name: Workloads in a subnet, from the store as it is
+  respiro.illumio.inventory_info:
+    username: "testusername"
+    auth_secret: "testpassword"
+    pce: "poc1.illum.io"
+    org_id: "85"
+    db: "/var/tmp/illumio_inventory.db"
+    refresh: false
+    ip: "10.0.1.0/24"
+'''
+
+RETURN = r'''
+workloads:
+    description: Workloads matching all the filters, with the hrefs of their labels
+    type: list
+    returned: always
+    sample: [
+        {
+            "href": "/orgs/85/workloads/1c2d8f34-0fd5-4c0a-8d2f-5d8a2c3d4b1e",
+            "name": "web01",
+            "hostname": "web01.corp.local",
+            "managed": true,
+            "labels": ["/orgs/85/labels/12", "/orgs/85/labels/40"]
+        }
+    ]
+'''
+
+from ansible.module_utils.basic import AnsibleModule
+import ipaddress
+
+# Import helper modules
+from ansible_collections.respiro.illumio.plugins.module_utils.credential import Credential
+from ansible_collections.respiro.illumio.plugins.module_utils.labels import LABEL_TYPES
+from ansible_collections.respiro.illumio.plugins.module_utils.inventory import InventoryStore, refresh_inventory
+from ansible_collections.respiro.illumio.plugins.module_utils.profiling import run_profiled
+
+
+# Query the store with every filter given and keep the workloads matching all of them
+def query_store(store, hostname=None, ip=None, label=None, missing_label=None):
+    key, value = label.split("=", 1) if label else (None, None)
+    results = []
+    if hostname:
+        results.append(store.workloads_by_hostname(hostname))
+    if ip:
+        results.append(store.workloads_by_ip(ip))
+    if missing_label:
+        results.append(store.workloads_without_label_type(missing_label, key, value))
+    elif label:
+        results.append(store.workloads_with_label(key, value))
+    if not results:
+        results.append(store.connection.execute("SELECT * FROM workloads").fetchall())
+
+    hrefs = set(row['href'] for row in results[0])
+    for rows in results[1:]:
+        hrefs &= set(row['href'] for row in rows)
+    workloads_list = []
+    for row in results[0]:
+        if row['href'] in hrefs:
+            workloads_list.append(dict(href=row['href'], name=row['name'], hostname=row['hostname'],
+                                       managed=bool(row['managed']),
+                                       labels=store.workload_label_hrefs(row['href'])))
+    return workloads_list
+
+
+def run_module():
+    module_args = dict(
+        username=dict(type='str', required=True),
+        auth_secret=dict(type='str', required=True, no_log=True),
+        pce=dict(type='str', required=True),
+        org_id=dict(type='str', required=True),
+        port=dict(type='str', required=False, default='443'),
+        db=dict(type='str', required=True),
+        refresh=dict(type='bool', required=False, default=True),
+        snapshot_dir=dict(type='str', required=False),
+        hostname=dict(type='str', required=False),
+        ip=dict(type='str', required=False),
+        label=dict(type='str', required=False),
+        missing_label=dict(type='str', required=False, choices=list(LABEL_TYPES)),
+    )
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+    label = module.params['label']
+    if label and "=" not in label:
+        module.fail_json(msg="Invalid label, expected type=name.")
+    if module.params['ip']:
+        try:
+            ipaddress.ip_network(module.params['ip'].strip(), strict=False)
+        except ValueError:
+            module.fail_json(msg="Invalid IP or subnet: {}".format(module.params['ip']))
+
+    # Initialize new credential
+    cred = Credential(module.params['username'], module.params['auth_secret'], module.params['pce'],
+                      "/orgs/" + module.params['org_id'], module.params['port'])
+
+    try:
+        if module.params['refresh']:
+            store = refresh_inventory(cred, module.params['db'], module.params['snapshot_dir'])
+        else:
+            store = InventoryStore(module.params['db'])
+        with store:
+            workloads_list = query_store(store, module.params['hostname'], module.params['ip'], label,
+                                         module.params['missing_label'])
+    except Exception as e:
+        module.fail_json(msg="Unable to refresh or query the inventory: {}".format(e))
+    module.exit_json(changed=False, workloads=workloads_list)
+
+
+def main():
+    run_profiled(run_module, "inventory_info")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+from __future__ import (absolute_import, division, print_function)
+
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+module: respiro.illumio.label_usage
+
+short_description: This module finds the labels used by no workload and optionally deletes them
+
+version_added: "1.1.5"
+
+description: This module counts, in one pass over a workload export, how many workloads use each label and reports
+the labels used by none of them. With delete, the unused labels are deleted concurrently; run it in check mode first
+to preview what would be deleted. The PCE refuses to delete a label that is still used elsewhere (rules, rulesets,
+label groups, pairing profiles,...), those labels are reported in errors and kept.
+
+options:
+    username:
+        description: This takes the user key value to access Illumio API
+        required: true
+        type: str
+    auth_secret:
+        description: This takes the API secret key to access Illumio API
+        required: true
+        type: str
+    pce:
+        description: This takes the url link to Illumio PCE. Required unless targets is given
+        required: false
+        type: str
+    org_id:
+        description: This takes the organisation ID for Illumio PCE. Required unless targets is given
+        required: false
+        type: str
+    port:
+        description: The port number, default to 443
+        required: false
+        type: str
+    targets:
+        description:
+            - List of PCE/org targets to clean up at the same time, instead of pce and org_id
+            - Each target takes pce, org_id and optionally port, username and auth_secret
+            - username, auth_secret default to the top-level values, port defaults to the top-level port
+        required: false
+        type: list
+        elements: dict
+    rate_limit:
+        description: Maximum number of requests per second sent to each PCE
+        required: false
+        type: float
+    transport:
+        description:
+            - HTTP transport used to reach the PCE
+            - http1 opens one connection per request in flight
+            - http2 multiplexes the requests in flight over a single connection, which helps with proxies limiting
+              the number of connections; requires the httpx and h2 Python packages
+            - stdlib only uses the Python standard library (no requests import), the quickest to start for small runs
+        required: false
+        type: str
+        choices: ['http1', 'http2', 'stdlib']
+        default: http1
+    concurrency:
+        description:
+            - fixed sends a fixed number of requests at the same time
+            - adaptive starts low and raises the number of requests in flight while the PCE's p95 latency stays
+              healthy, and halves it on HTTP 429/503, timeouts, connection errors or rising latency (AIMD)
+            - With adaptive, the limit reached is returned under concurrency
+        required: false
+        type: str
+        choices: ['fixed', 'adaptive']
+        default: fixed
+    snapshot_dir:
+        description:
+            - Directory of the local snapshots of labels and workloads
+            - Only the changes since the last run are fetched
+        required: false
+        type: str
+    types:
+        description: Only look at the labels of these types, all labels by default
+        required: false
+        type: list
+        elements: str
+        choices: ['role', 'app', 'env', 'loc']
+    delete:
+        description: Delete the unused labels (check mode only reports them)
+        required: false
+        type: bool
+        default: false
+    workers:
+        description: Number of labels deleted at the same time (with concurrency fixed)
+        required: false
+        type: int
+        default: 8
+
+author:
+    - Nghia Huu (David) Nguyen (@DAVPFSN)
+'''
+
+EXAMPLES = r'''
+- name: Preview the cleanup of unused application and role labels
+  respiro.illumio.label_usage:
+    username: "testusername"
+    auth_secret: "testpassword"
+    pce: "poc1.illum.io"
+    org_id: "85"
+    types: ["app", "role"]
+    delete: true
+  check_mode: true
+
+- name: Delete every label used by no workload
+  respiro.illumio.label_usage:
+    username: "testusername"
+    auth_secret: "testpassword"
+    pce: "poc1.illum.io"
+    org_id: "85"
+    delete: true
+
+- name: Report the unused labels of two PCEs at once
+  respiro.illumio.label_usage:
+    username: "testusername"
+    auth_secret: "testpassword"
+    targets:
+      - pce: "poc1.illum.io"
+        org_id: "85"
+      - pce: "poc2.illum.io"
+        org_id: "3"
+'''
+
+RETURN = r'''
+summary:
+    description: Per label type, the number of labels and how many of them are used by no workload
+    type: dict
+    returned: when targets is not given
+    sample: {"app": {"total": 1200, "unused": 310}, "env": {"total": 4, "unused": 0}}
+unused:
+    description: Labels used by no workload
+    type: list
+    returned: when targets is not given
+    sample: [{"href": "/orgs/85/labels/512", "key": "app", "value": "legacy-crm"}]
+deleted:
+    description: Hrefs of the labels deleted (or that would be deleted in check mode)
+    type: list
+    returned: when delete is true
+    sample: ["/orgs/85/labels/512"]
+errors:
+    description: Unused labels the PCE refused to delete, usually because a rule or another object still uses them
+    type: list
+    returned: when delete is true and not in check mode
+    sample: ["/orgs/85/labels/513 (HTTP 406)"]
+concurrency:
+    description: State of the adaptive concurrency limit at the end of the run
+    type: dict
+    returned: when concurrency is adaptive
+    sample: {"limit": 12, "min_limit": 4, "max_limit": 14, "decreases": 2, "p95_ms": 180.4}
+targets:
+    description: Per-target results (summary, unused, deleted, errors), tagged with pce and org_href
+    type: list
+    returned: when targets is given
+    sample: [
+        {"pce": "poc1.illum.io", "org_href": "/orgs/85", "changed": false,
+         "summary": {"app": {"total": 1200, "unused": 310}}, "unused": [{"href": "/orgs/85/labels/512",
+                                                                        "key": "app", "value": "legacy-crm"}]}
+    ]
+'''
+
+from ansible.module_utils.basic import AnsibleModule, missing_required_lib
+
+# Import helper modules
+from ansible_collections.respiro.illumio.plugins.module_utils.api_calls import TRANSPORTS, HAS_HTTP2, decode
+from ansible_collections.respiro.illumio.plugins.module_utils.credential import TARGET_OPTIONS, credentials_from_params
+from ansible_collections.respiro.illumio.plugins.module_utils.concurrency import DEFAULT_WORKERS, prefetch, \
+    with_concurrency, fan_out, exit_fan_out
+from ansible_collections.respiro.illumio.plugins.module_utils.labels import LABEL_TYPES, get_labels, sync_labels, \
+    label_usage, delete_labels
+from ansible_collections.respiro.illumio.plugins.module_utils.workloads import LABEL_FIELDS, fetch_workloads, \
+    sync_workloads
+from ansible_collections.respiro.illumio.plugins.module_utils.profiling import run_profiled
+
+
+# Find the labels (of the given types) used by no workload of a PCE, and delete them if asked to
+# Returns the module's result
+def clean_up_labels(cred, types=None, delete=False, check_mode=False, snapshot_dir=None, workers=DEFAULT_WORKERS):
+    # Labels and workloads (only their labels) are fetched at the same time
+    if snapshot_dir:
+        inventory = prefetch(cred,
+                             labels=lambda cred: sync_labels(cred, snapshot_dir),
+                             workloads=lambda cred: sync_workloads(cred, snapshot_dir, LABEL_FIELDS))
+    else:
+        inventory = prefetch(cred,
+                             labels=lambda cred: decode(get_labels(cred)),
+                             workloads=lambda cred: fetch_workloads(cred, LABEL_FIELDS))
+    usage = label_usage(inventory['workloads'])
+
+    summary = dict()
+    unused = []
+    for label in inventory['labels']:
+        if label.get('deleted') or (types and label['key'] not in types):
+            continue
+        counts = summary.setdefault(label['key'], dict(total=0, unused=0))
+        counts['total'] += 1
+        if not usage[label['href']]:
+            counts['unused'] += 1
+            unused.append(dict(href=label['href'], key=label['key'], value=label['value']))
+    result = dict(changed=False, summary=summary, unused=unused)
+    if not delete:
+        return result
+
+    hrefs = [label['href'] for label in unused]
+    result.update(changed=bool(hrefs), deleted=hrefs)
+    if check_mode:
+        return result
+    responses = delete_labels(cred, hrefs, workers)
+    result['deleted'] = [href for href, response in zip(hrefs, responses) if response.status_code == 204]
+    result['errors'] = ["{} (HTTP {})".format(href, response.status_code)
+                        for href, response in zip(hrefs, responses) if response.status_code != 204]
+    result['changed'] = bool(result['deleted'])
+    return result
+
+
+def run_module():
+    module_args = dict(
+        username=dict(type='str', required=True),
+        auth_secret=dict(type='str', required=True, no_log=True),
+        pce=dict(type='str', required=False),
+        org_id=dict(type='str', required=False),
+        port=dict(type='str', required=False, default='443'),
+        targets=dict(type='list', elements='dict', required=False, options=TARGET_OPTIONS),
+        rate_limit=dict(type='float', required=False),
+        transport=dict(type='str', required=False, default='http1', choices=list(TRANSPORTS)),
+        concurrency=dict(type='str', required=False, default='fixed', choices=['fixed', 'adaptive']),
+        snapshot_dir=dict(type='str', required=False),
+        types=dict(type='list', elements='str', required=False, choices=list(LABEL_TYPES)),
+        delete=dict(type='bool', required=False, default=False),
+        workers=dict(type='int', required=False, default=DEFAULT_WORKERS),
+    )
+    module = AnsibleModule(
+        argument_spec=module_args,
+        required_one_of=[('pce', 'targets')],
+        required_together=[('pce', 'org_id')],
+        mutually_exclusive=[('pce', 'targets')],
+        supports_check_mode=True
+    )
+    if module.params['transport'] == 'http2' and not HAS_HTTP2:
+        module.fail_json(msg=missing_required_lib('httpx[http2]'))
+
+    # Initialize new credentials, one per PCE/org
+    creds = credentials_from_params(module.params)
+    options = (module.params['types'], module.params['delete'], module.check_mode, module.params['snapshot_dir'],
+               module.params['workers'])
+
+    # Labels the PCE refuses to delete are reported in errors, the others are still deleted
+    if module.params['targets']:
+        exit_fan_out(module, fan_out(creds, clean_up_labels, *options))
+    module.exit_json(**with_concurrency(creds[0], clean_up_labels(creds[0], *options)))
+
+
+def main():
+    run_profiled(run_module, "label_usage")
+
+
+if __name__ == '__main__':
+    main()
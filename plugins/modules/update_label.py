@@ -15,12 +15,14 @@ version_added: "1.1.0"
 description: When executed, the module will use the provided label ID to try to retrieve the
 current label's name. If successful, it will try to update the label's name to the new value 
 supplied by the user; else, it will report a failure with a message that points out the most
-likely cause of the error
+likely cause of the error.
+Many labels can be renamed in a single run by giving a list (labels) or a csv file (path) instead of label_id:
+all labels are fetched once, compared in memory and only the ones that need to change are updated, concurrently.
 
 options:
     pce:
-        description: This takes the hostname from the URL link to Illumio PCE
-        required: true
+        description: This takes the hostname from the URL link to Illumio PCE. Required unless targets is given
+        required: false
         type: str
     port:
         description:
@@ -28,13 +30,44 @@ options:
             - Default to 443
         required: false
         type: str
+    transport:
+        description:
+            - HTTP transport used to reach the PCE
+            - http1 opens one connection per request in flight
+            - http2 multiplexes the requests in flight over a single connection, which helps with proxies limiting
+              the number of connections; requires the httpx and h2 Python packages
+            - stdlib only uses the Python standard library (no requests import), the quickest to start for small runs
+        required: false
+        type: str
+        choices: ['http1', 'http2', 'stdlib']
+        default: http1
+    concurrency:
+        description:
+            - fixed sends a fixed number of requests at the same time
+            - adaptive starts low and raises the number of requests in flight while the PCE's p95 latency stays
+              healthy, and halves it on HTTP 429/503, timeouts, connection errors or rising latency (AIMD)
+            - With adaptive, the limit reached is returned under concurrency
+        required: false
+        type: str
+        choices: ['fixed', 'adaptive']
+        default: fixed
     org_id:
-        description: This takes the organisation ID for Illumio PCE
-        required: true
+        description: This takes the organisation ID for Illumio PCE. Required unless targets is given
+        required: false
         type: str
+    targets:
+        description:
+            - List of PCE/org targets to rename the labels on at the same time, instead of pce and org_id
+            - Each target takes pce, org_id and optionally port, username and auth_secret
+            - username, auth_secret default to the top-level values, port defaults to the top-level port
+            - Only with labels or path whose entries give key and value; label IDs differ between PCEs, so label_id
+              can't be used with targets
+        required: false
+        type: list
+        elements: dict
     label_id:
-        description: This takes the label ID that needs to be updated
-        required: true
+        description: This takes the label ID that needs to be updated. Required unless labels or path is given
+        required: false
         type: str
     username:
         description: This takes the user key value to access Illumio API. Generate the API key from PCE 
@@ -46,10 +79,40 @@ options:
         required: true
         type: str
     new_value:
-        description: This takes the new value that the user want the label's name to be updated to
-        required: true
+        description: This takes the new value that the user want the label's name to be updated to. Required with label_id
+        required: false
         type: str
-    
+    labels:
+        description:
+            - List of labels to rename, each one with new_value and either label_id or key and value (current name)
+            - When several entries are for the same label, the last one wins
+            - Renames depending on each other (e.g. r2 to r3 and r3 to r9) are sent in order
+        required: false
+        type: list
+        elements: dict
+        suboptions:
+            label_id:
+                description: ID of the label to rename
+                required: false
+                type: str
+            key:
+                description: Type of the label to rename, with value
+                required: false
+                type: str
+            value:
+                description: Current name of the label to rename, with key
+                required: false
+                type: str
+            new_value:
+                description: New name of the label
+                required: true
+                type: str
+    path:
+        description:
+            - Path to a csv file of labels to rename, with the columns label_id,new_value or key,value,new_value
+        required: false
+        type: str
+
 author:
     - Nghia Huu (David) Nguyen (@DAVPFSN)
 '''
@@ -66,6 +129,37 @@ EXAMPLES = r'''
     auth_secret: "somesecret"
     new_value: "HelloWorld"
 
+# Rename many labels at once
+- name: Test with a list of labels
+  respiro.illumio.update_label:
+    pce: "pod.someorganisation.com"
+    port: "8443"
+    org_id: "9"
+    username: "someuser"
+    auth_secret: "somesecret"
+    labels:
+      - label_id: "65821"
+        new_value: "A-HelloWorld"
+      - key: "env"
+        value: "prod"
+        new_value: "E-Production"
+
+# Rename the same labels on two PCEs at once
+- name: Test with several targets
+  respiro.illumio.update_label:
+    username: "someuser"
+    auth_secret: "somesecret"
+    targets:
+      - pce: "pod.someorganisation.com"
+        port: "8443"
+        org_id: "9"
+      - pce: "pod2.someorganisation.com"
+        org_id: "3"
+    labels:
+      - key: "env"
+        value: "prod"
+        new_value: "E-Production"
+
 # fail the module
 - name: Test failure of the module
   respiro.illumio.update_label:
@@ -110,27 +204,183 @@ success:
     type: str
     returned: When the label has been updated successfully
     sample: "Successfully update abc1 to abc2"
+changes:
+    description: The renames that are (or, in check mode, would be) made, only with labels or path
+    type: list
+    returned: When labels or path is given
+    sample: ["env: prod -> E-Production"]
+unchanged:
+    description: Labels that already have their new value, only with labels or path
+    type: list
+    returned: When labels or path is given
+    sample: ["app: A-HelloWorld"]
+not_found:
+    description: Entries that don't match any label, only with labels or path
+    type: list
+    returned: When labels or path is given
+    sample: ["65822", "loc: nowhere"]
+conflicts:
+    description: Renames skipped because another label of the same type would end up with the same name
+    type: list
+    returned: When labels or path is given
+    sample: ["role: web -> db"]
+errors:
+    description: Renames the PCE refused, with the HTTP status code
+    type: list
+    returned: When labels or path is given and not in check mode
+    sample: ["role: web -> web-tier (HTTP 406)"]
+concurrency:
+    description: State of the adaptive concurrency limit at the end of the run
+    type: dict
+    returned: when concurrency is adaptive and labels or path is given
+    sample: {"limit": 12, "min_limit": 4, "max_limit": 14, "decreases": 2, "p95_ms": 180.4}
+targets:
+    description: Per-target results (changes, unchanged, not_found, conflicts, errors), tagged with pce and org_href
+    type: list
+    returned: When targets is given
+    sample: [{"pce": "pod.someorganisation.com", "org_href": "/orgs/9", "changed": true,
+              "changes": ["env: prod -> E-Production"], "unchanged": [], "not_found": [], "conflicts": [], "errors": []}]
 '''
 
-from ansible.module_utils.basic import AnsibleModule
-import json
-from requests.exceptions import ConnectionError, Timeout
+from ansible.module_utils.basic import AnsibleModule, missing_required_lib
+from collections import Counter, OrderedDict
+import csv
 
 # Import helper modules
-from ansible_collections.respiro.illumio.plugins.module_utils.credential import Credential
-from ansible_collections.respiro.illumio.plugins.module_utils.labels import get_label, update_label
+from ansible_collections.respiro.illumio.plugins.module_utils.credential import TARGET_OPTIONS, credentials_from_params
+from ansible_collections.respiro.illumio.plugins.module_utils.labels import get_label, get_labels, update_label
+from ansible_collections.respiro.illumio.plugins.module_utils.concurrency import run_concurrently, workers_for, \
+    with_concurrency, fan_out, exit_fan_out
+from ansible_collections.respiro.illumio.plugins.module_utils.api_calls import TRANSPORTS, HAS_HTTP2, TransportError, \
+    TransportTimeout, decode
+from ansible_collections.respiro.illumio.plugins.module_utils.profiling import run_profiled
+
+
+# Send the renames (href, new value, change) so that none takes a name another label still holds
+# The PCE requires unique names per label type, so in a chain (r2 -> r3 and r3 -> r9) r3 -> r9 is sent first:
+# renames are sent in waves, each wave concurrently, with the renames whose new name is free
+# A cycle (r2 -> r3 and r3 -> r2) is broken by renaming one of its labels to a temporary name first
+# Renames waiting for a rename that failed are not sent
+# Returns the errors
+def _apply_renames(cred, labels_list, updates):
+    keys = dict((label['href'], label['key']) for label in labels_list)
+    # Current name of every label and label holding each name, kept up to date as labels are renamed
+    values = dict((label['href'], label['value']) for label in labels_list)
+    holders = dict(((label['key'], label['value']), label['href']) for label in labels_list)
+    pending = OrderedDict((href, (new_value, change)) for href, new_value, change in updates)
+    errors = []
+
+    def rename(href, new_value):
+        response = update_label(cred, href, {"value": new_value})
+        if response.status_code == 204:
+            del holders[(keys[href], values[href])]
+            holders[(keys[href], new_value)] = href
+            values[href] = new_value
+        return response
+
+    while pending:
+        ready = []
+        blocked = []
+        for href, (new_value, change) in pending.items():
+            holder = holders.get((keys[href], new_value))
+            if holder is None:
+                ready.append(href)
+            elif holder not in pending:
+                blocked.append(href)
+        if ready:
+            responses = run_concurrently(lambda href: rename(href, pending[href][0]), ready, workers_for(cred))
+            for href, response in zip(ready, responses):
+                if response.status_code != 204:
+                    errors.append("{} (HTTP {})".format(pending[href][1], response.status_code))
+                del pending[href]
+        elif blocked:
+            for href in blocked:
+                errors.append("{} (not sent, the label holding the new name wasn't renamed)".format(pending[href][1]))
+                del pending[href]
+        else:
+            # Every pending rename waits for another one: break a cycle with a temporary name
+            href = next(iter(pending))
+            temporary = values[href] + ".renaming"
+            while (keys[href], temporary) in holders:
+                temporary += "_"
+            response = rename(href, temporary)
+            if response.status_code != 204:
+                errors.append("{} (HTTP {})".format(pending[href][1], response.status_code))
+                del pending[href]
+    return errors
+
+
+# Rename many labels at once
+# All labels are fetched once and compared in memory with the mappings
+# (dicts with new_value and either label_id or key and value),
+# then only the labels that need to change are updated, concurrently (see _apply_renames)
+# In check mode nothing is updated and the result is a preview of the changes
+def rename_labels(cred, mappings, check_mode):
+    labels_list = decode(get_labels(cred))
+    by_href = dict((label['href'], label) for label in labels_list)
+    by_name = dict(((label['key'], label['value']), label) for label in labels_list)
+
+    # Find the label of every mapping, the last mapping of a label wins
+    new_values = dict()
+    not_found = []
+    for mapping in mappings:
+        if mapping.get('label_id'):
+            name = str(mapping['label_id'])
+            label = by_href.get(cred.org_href + "/labels/" + name)
+        else:
+            name = "{}: {}".format(mapping.get('key'), mapping.get('value'))
+            label = by_name.get((mapping.get('key'), mapping.get('value')))
+        if label is None:
+            not_found.append(name)
+        else:
+            new_values[label['href']] = mapping['new_value']
+
+    # Names every label will have once all renames are done
+    final_names = Counter((label['key'], new_values.get(label['href'], label['value'])) for label in labels_list)
+
+    updates = []
+    unchanged = []
+    conflicts = []
+    for href, new_value in new_values.items():
+        label = by_href[href]
+        change = "{}: {} -> {}".format(label['key'], label['value'], new_value)
+        if label['value'] == new_value:
+            unchanged.append("{}: {}".format(label['key'], new_value))
+        elif final_names[(label['key'], new_value)] > 1:
+            conflicts.append(change)
+        else:
+            updates.append((href, new_value, change))
+
+    result = dict(changed=bool(updates), changes=[update[2] for update in updates], unchanged=unchanged,
+                  not_found=not_found, conflicts=conflicts)
+    if check_mode:
+        return result
+
+    result['errors'] = _apply_renames(cred, labels_list, updates)
+    result['changed'] = len(result['errors']) < len(updates)
+    return result
 
 
 def run_module():
     # Define available arguments/parameters a user can pass to the module
     module_args = dict(
-        pce=dict(type='str', required=True),
+        pce=dict(type='str', required=False),
         port=dict(type='str', required=False, default='443'),
-        org_id=dict(type='str', required=True),
-        label_id=dict(type='str', required=True),
+        transport=dict(type='str', required=False, default='http1', choices=list(TRANSPORTS)),
+        concurrency=dict(type='str', required=False, default='fixed', choices=['fixed', 'adaptive']),
+        org_id=dict(type='str', required=False),
+        targets=dict(type='list', elements='dict', required=False, options=TARGET_OPTIONS),
+        label_id=dict(type='str', required=False),
         username=dict(type='str', required=True),
         auth_secret=dict(type='str', required=True),
-        new_value=dict(type='str', required=True)
+        new_value=dict(type='str', required=False),
+        labels=dict(type='list', elements='dict', required=False, options=dict(
+            label_id=dict(type='str', required=False),
+            key=dict(type='str', required=False),
+            value=dict(type='str', required=False),
+            new_value=dict(type='str', required=True),
+        )),
+        path=dict(type='str', required=False),
     )
 
     # Initialise result dictionary to be passed back to the user
@@ -141,26 +391,50 @@ def run_module():
     # Required to work with Ansible
     module = AnsibleModule(
         argument_spec=module_args,
+        required_one_of=[('label_id', 'labels', 'path'), ('pce', 'targets')],
+        mutually_exclusive=[('label_id', 'labels', 'path'), ('pce', 'targets'), ('label_id', 'targets')],
+        required_together=[('label_id', 'new_value'), ('pce', 'org_id')],
         supports_check_mode=True
     )
+    if module.params['transport'] == 'http2' and not HAS_HTTP2:
+        module.fail_json(msg=missing_required_lib('httpx[http2]'))
 
     # Extract parameters from AnsibleModule object
-    pce = module.params['pce']
-    port = module.params['port']
-    org_href = "/orgs/" + module.params['org_id']
-    label_href = org_href + "/labels/" + module.params['label_id']
-    username = module.params['username']
-    auth_secret = module.params['auth_secret']
     new_value = module.params['new_value']
 
-    # Initialise new credential
-    cred = Credential(username, auth_secret, pce, org_href, port)
-
-    # Construct request payload
-    data = {"value": new_value}
+    # Initialise new credentials, one per PCE/org
+    creds = credentials_from_params(module.params)
+    cred = creds[0]
 
     try:
 
+        # Rename every label of the list or csv file at once
+        if module.params['labels'] or module.params['path']:
+            mappings = module.params['labels']
+            if module.params['path']:
+                with open(module.params['path'], 'r') as data_file:
+                    mappings = list(csv.DictReader(data_file, delimiter=","))
+            # Rename the labels on every target at once
+            # Label IDs differ between PCEs, so the labels must be identified by key and value
+            if module.params['targets']:
+                if any(mapping.get('label_id') for mapping in mappings):
+                    module.fail_json(msg="label_id can't be used with targets, identify the labels by key and value.",
+                                     **result)
+                results = fan_out(creds, rename_labels, mappings, module.check_mode)
+                for target_result in results:
+                    if target_result.get('errors'):
+                        target_result.update(failed=True, msg="Some labels couldn't be renamed.")
+                exit_fan_out(module, results)
+            result.update(with_concurrency(cred, rename_labels(cred, mappings, module.check_mode)))
+            if result.get('errors'):
+                module.fail_json(msg="Some labels couldn't be renamed.", **result)
+            module.exit_json(**result)
+
+        label_href = cred.org_href + "/labels/" + module.params['label_id']
+
+        # Construct request payload
+        data = {"value": new_value}
+
         # Check to see if the label exists
         response_get = get_label(cred, label_href)
 
@@ -169,7 +443,7 @@ def run_module():
         # If yes then exit
         # If no then update
         if response_get.status_code == 200:
-            current_value = json.loads(response_get.content)['value']
+            current_value = decode(response_get)['value']
             if current_value == new_value:
                 module.exit_json(ok="Current label's name is already the same as input value. "
                                     "Additional change is not required.", **result)
@@ -204,16 +478,16 @@ def run_module():
         else:
             module.fail_json(msg="Error occurred when requesting API.", **result)
 
-    except Timeout as e:
+    except TransportTimeout as e:
         module.fail_json(msg="Connection timeout. Please check your internet connection or port number.", **result)
-    except ConnectionError as e:
+    except TransportError as e:
         module.fail_json(msg="Fail to establish a connection. Make sure your pce is correct.", **result)
     except Exception as e:
         module.fail_json(msg="Fail due to unexpected issue.", **result)
 
 
 def main():
-    run_module()
+    run_profiled(run_module, "update_label")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,37 @@
+from __future__ import (absolute_import, division, print_function)
+
+__metaclass__ = type
+
+from ansible_collections.respiro.illumio.plugins.module_utils.concurrency import AdaptiveLimiter, LATENCY_TOLERANCE
+
+
+# Send a window of requests, all with the same latency and status
+def run_window(limiter, latency, status=200):
+    for _ in range(limiter.window):
+        limiter.release(limiter.acquire(), latency, status)
+
+
+def test_limit_grows_while_latency_is_healthy():
+    limiter = AdaptiveLimiter(initial=4, maximum=16)
+    for _ in range(20):
+        run_window(limiter, 0.1)
+    assert int(limiter.limit) == 16
+
+
+def test_limit_halves_on_overload():
+    limiter = AdaptiveLimiter(initial=8)
+    run_window(limiter, 0.1)
+    limiter.release(limiter.acquire(), 0.1, 429)
+    assert int(limiter.limit) == 4
+
+
+def test_limit_recovers_when_latency_settles_higher():
+    limiter = AdaptiveLimiter(initial=4, maximum=16)
+    for _ in range(10):
+        run_window(limiter, 0.1)
+    # The PCE becomes lastingly slower: a few cuts, then the baseline has caught up and the limit grows again
+    for _ in range(200):
+        run_window(limiter, 1.0)
+    assert int(limiter.limit) == 16
+    assert 1.0 <= limiter.baseline * LATENCY_TOLERANCE
+    assert limiter.decreases < 10
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+"""
+Measure how long each module of the collection takes to start:
+- Import time of the module (and everything it imports), from python -X importtime
+- Wall time of a fresh interpreter importing it, minus the time of an empty interpreter
+- The slowest imports of each module, to see what is worth making lazy
+Every measure is the median of several runs, each in a new interpreter (like AnsiballZ runs a module)
+
+Usage: python tools/startup_benchmark.py [--repeat 10] [--top 5] [--python /path/to/python] [module ...]
+"""
+
+__author__ = "Nghia Huu (David) Nguyen"
+__copyright__ = "Copyright 2021"
+__credits__ = ["David Nguyen"]
+__license__ = "GPL"
+__version__ = "1.0.0"
+__maintainer__ = "David Nguyen"
+__email__ = "davidnguyen0207@gmail.com"
+__status__ = "In Development"
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+# Root of the collection (this script is in <root>/tools)
+COLLECTION_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES_PACKAGE = "ansible_collections.respiro.illumio.plugins.modules"
+
+
+# Directory to put on PYTHONPATH so the collection can be imported as ansible_collections.respiro.illumio
+# Uses the checkout's own location when it's already installed that way, a temporary symlink otherwise
+def collections_path(temp_dir):
+    parent = os.path.dirname(COLLECTION_ROOT)
+    if os.path.basename(parent) == "respiro" and os.path.basename(os.path.dirname(parent)) == "ansible_collections":
+        return os.path.dirname(os.path.dirname(parent))
+    namespace = os.path.join(temp_dir, "ansible_collections", "respiro")
+    os.makedirs(namespace)
+    os.symlink(COLLECTION_ROOT, os.path.join(namespace, "illumio"))
+    return temp_dir
+
+
+# Names of the collection's modules
+def module_names():
+    directory = os.path.join(COLLECTION_ROOT, "plugins", "modules")
+    return sorted(name[:-3] for name in os.listdir(directory) if name.endswith(".py") and name != "__init__.py")
+
+
+# Run "import <module>" in a new interpreter
+# Returns the wall time (in seconds) and the import times {module: (cumulative us, importing module)}
+def run_import(python, env, module):
+    code = "import " + module if module else "pass"
+    start = time.perf_counter()
+    process = subprocess.run([python, "-X", "importtime", "-c", code], env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    wall = time.perf_counter() - start
+    if process.returncode != 0:
+        raise RuntimeError("Importing {} failed:\n{}".format(module, process.stderr[-2000:]))
+    # One line per import, after the ones it triggered, indented by 2 spaces per level of nesting
+    entries = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            continue
+        name = fields[2].rstrip()
+        entries.append((name.strip(), (len(name) - len(name.lstrip()) - 1) // 2, cumulative))
+
+    # The module importing each one is the next line with a lower level
+    imports = dict()
+    parents = []
+    for name, level, cumulative in reversed(entries):
+        while parents and parents[-1][1] >= level:
+            parents.pop()
+        imports[name] = (cumulative, parents[-1][0] if parents else None)
+        parents.append((name, level))
+    return wall, imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the import and startup time of the collection's modules.")
+    parser.add_argument("modules", nargs="*", help="Modules to measure (default: all of them)")
+    parser.add_argument("--repeat", type=int, default=10, help="Runs per module (default: 10)")
+    parser.add_argument("--top", type=int, default=5, help="Slowest imports listed per module (default: 5)")
+    parser.add_argument("--python", default=sys.executable, help="Interpreter to measure (default: this one)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [collections_path(temp_dir), env.get("PYTHONPATH")]))
+
+        # Warm up the bytecode caches and the OS file cache, then measure an empty interpreter
+        baseline = statistics.median(run_import(args.python, env, None)[0] for _ in range(args.repeat))
+        print("Empty interpreter: {:.1f} ms".format(baseline * 1000))
+        print("{:<24} {:>12} {:>14}".format("module", "import (ms)", "startup (ms)"))
+
+        for name in args.modules or module_names():
+            module = MODULES_PACKAGE + "." + name
+            run_import(args.python, env, module)
+            runs = [run_import(args.python, env, module) for _ in range(args.repeat)]
+            wall = statistics.median(run[0] for run in runs)
+            imported = statistics.median(run[1].get(module, (0, None))[0] for run in runs) / 1000.0
+            print("{:<24} {:>12.1f} {:>14.1f}".format(name, imported, (wall - baseline) * 1000))
+
+            # Slowest imports made by the collection's own code (last run, cumulative time)
+            imports = runs[-1][1]
+            external = sorted(((cumulative, package) for package, (cumulative, parent) in imports.items()
+                               if parent and parent.startswith("ansible_collections.")
+                               and package.split(".")[0] != "ansible_collections"), reverse=True)
+            for cumulative, package in external[:args.top]:
+                print("    {:<30} {:>8.1f}".format(package, cumulative / 1000.0))
+
+
+if __name__ == '__main__':
+    main()